@@ -13,8 +13,320 @@
 # limitations under the License.
 
 """Wrapper for the Lintel C extension APIs."""
+import bisect
+import concurrent.futures
+
+import numpy as np
+
 import _lintel
 
 
 loadvid = _lintel.loadvid
-loadvid_frame_nums = _lintel.loadvid_frame_nums
+
+# NOTE(brendan): numpy has no bfloat16 type, so bfloat16 frames are stored as
+# their uint16 bit patterns.
+_NUMPY_DTYPES = {'uint8': np.uint8,
+                 'float32': np.float32,
+                 'float16': np.float16,
+                 'bfloat16': np.uint16}
+
+
+def make_output_buffer(num_frames,
+                       height,
+                       width,
+                       dtype='uint8',
+                       layout='NHWC',
+                       pix_fmt='rgb24'):
+    """Allocates an array that can be passed as `out` to `loadvid` and
+    `loadvid_frame_nums`, to decode `num_frames` frames of size
+    `width`x`height` in pixel format `pix_fmt`, with elements of type `dtype`
+    and laid out as given by `layout`.
+
+    Reusing one output array across calls avoids allocating a new
+    `num_frames*height*width*3` element array per decoded clip.
+    """
+    if pix_fmt == 'yuv420p':
+        if (width % 2 != 0) or (height % 2 != 0):
+            raise ValueError("pix_fmt 'yuv420p' requires an even width and "
+                             "height")
+        return np.empty((num_frames, height*3//2, width), dtype=np.uint8)
+
+    channels = 1 if pix_fmt == 'gray' else 3
+    if layout == 'NCHW':
+        shape = (num_frames, channels, height, width)
+    else:
+        shape = (num_frames, height, width, channels)
+
+    return np.empty(shape, dtype=_NUMPY_DTYPES[dtype])
+
+
+def _normalize_frame_nums(frame_nums):
+    """Sorts and de-duplicates `frame_nums`, since the C extension decodes
+    frames in one forward pass and so requires strictly increasing frame
+    numbers.
+
+    Returns a tuple (frame_nums, inverse). If `frame_nums` is already strictly
+    increasing, it is returned as is and `inverse` is None. Otherwise the
+    sorted, unique frame numbers are returned, along with the indices
+    `inverse` into them of the original `frame_nums`, i.e., frames decoded
+    from the sorted frame numbers can be put back in the requested order with
+    `np.take(frames, inverse, axis=0)`.
+    """
+    frame_nums_array = np.asarray(frame_nums)
+    if frame_nums_array.size == 0:
+        return frame_nums, None
+
+    inverse = None
+    if not np.all(np.diff(frame_nums_array) > 0):
+        frame_nums_array, inverse = np.unique(frame_nums_array,
+                                              return_inverse=True)
+        frame_nums = frame_nums_array.tolist()
+
+    if frame_nums_array[0] < 0:
+        raise ValueError('frame_nums must be non-negative')
+
+    return frame_nums, inverse
+
+
+def _gather_frames(result, inverse, out, is_size_dynamic):
+    """Puts frames decoded from sorted, unique frame numbers back in the
+    requested order (see `_normalize_frame_nums`), into `out` if it is passed.
+
+    `result` is as returned by `_lintel.loadvid_frame_nums`, and the result is
+    returned in the same form.
+    """
+    if is_size_dynamic:
+        frames, width, height = result
+        return np.take(frames, inverse, axis=0, out=out), width, height
+
+    return np.take(result, inverse, axis=0, out=out)
+
+
+class VideoReader(_lintel.VideoReader):
+    """Opens an encoded video once, to decode frames from it repeatedly.
+
+    See `_lintel.VideoReader` for the arguments. `load` additionally accepts
+    frame numbers in any order, including repeated frame numbers, as
+    `loadvid_frame_nums` does.
+    """
+
+    def load(self, frame_nums, *, should_seek=False, out=None):
+        frame_nums, inverse = _normalize_frame_nums(frame_nums)
+        if inverse is None:
+            return super().load(frame_nums, should_seek=should_seek, out=out)
+
+        frames = super().load(frame_nums, should_seek=should_seek)
+
+        return _gather_frames(frames, inverse, out, False)
+
+
+def _shard_frame_nums(frame_nums, keyframe_nums, num_shards):
+    """Splits `frame_nums` into at most `num_shards` contiguous runs.
+
+    Runs are only split at keyframe boundaries, so that each run can be decoded
+    independently after a single seek, without re-decoding any GOP that another
+    run also decodes. Each split is made at the GOP boundary closest to where
+    an even split into `num_shards` runs would fall.
+
+    Returns a list of (offset, run) tuples, where `offset` is the index in
+    `frame_nums` of the first frame in `run`.
+    """
+    gop_starts = []
+    prev_gop = None
+    for i, frame_num in enumerate(frame_nums):
+        gop = bisect.bisect_right(keyframe_nums, frame_num)
+        if (gop != prev_gop) and (i > 0):
+            gop_starts.append(i)
+        prev_gop = gop
+
+    splits = set()
+    if gop_starts:
+        for shard in range(1, num_shards):
+            ideal_split = shard*len(frame_nums)/num_shards
+            splits.add(min(gop_starts,
+                           key=lambda start: abs(start - ideal_split)))
+
+    bounds = [0] + sorted(splits) + [len(frame_nums)]
+
+    return [(start, frame_nums[start:end])
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _loop_frames(frames, num_decoded, num_frames, frame_bytes):
+    """Fills frames `num_decoded` to `num_frames` of the buffer `frames`, each
+    `frame_bytes` bytes, by looping the first `num_decoded` frames, as the C
+    extension does for frame numbers past the end of the video.
+    """
+    flat_frames = np.frombuffer(frames, dtype=np.uint8)
+    flat_frames = flat_frames[:num_frames*frame_bytes]
+    flat_frames = flat_frames.reshape(num_frames, frame_bytes)
+    looped = np.arange(num_decoded, num_frames) % num_decoded
+    flat_frames[num_decoded:] = flat_frames[looped]
+
+
+def _loadvid_sorted_frame_nums(encoded_video,
+                               *,
+                               frame_nums,
+                               width,
+                               height,
+                               should_seek,
+                               num_shards,
+                               hwaccel,
+                               out,
+                               num_threads,
+                               pix_fmt,
+                               dtype,
+                               layout,
+                               mean,
+                               std):
+    """Implements `loadvid_frame_nums`, for strictly increasing `frame_nums`.
+
+    If `should_seek` is set and `num_shards` is greater than one, the frame
+    indices are split at keyframe boundaries into (at most) `num_shards` runs,
+    which are decoded concurrently, each on its own thread and from its own
+    seek point, into one shared output array. Each shard's decoder uses
+    `num_threads` threads, so when sharding, `num_threads` should usually be
+    set so that `num_shards*num_threads` does not exceed the number of cores.
+    """
+    if (num_shards <= 1) or (not should_seek):
+        return _lintel.loadvid_frame_nums(encoded_video,
+                                          frame_nums=frame_nums,
+                                          width=width,
+                                          height=height,
+                                          should_seek=should_seek,
+                                          hwaccel=hwaccel,
+                                          out=out,
+                                          num_threads=num_threads,
+                                          pix_fmt=pix_fmt,
+                                          dtype=dtype,
+                                          layout=layout,
+                                          mean=mean,
+                                          std=std)
+
+    keyframe_nums, video_width, video_height, nb_frames = (
+        _lintel.get_keyframe_frame_nums(encoded_video))
+
+    # NOTE(brendan): Frame numbers at or past the end of the video are not
+    # sharded, but filled in afterwards by looping the decoded frames, the same
+    # as when decoding serially.
+    num_decoded = bisect.bisect_left(frame_nums, nb_frames)
+    shards = _shard_frame_nums(frame_nums[:num_decoded],
+                               sorted(keyframe_nums),
+                               num_shards)
+    if len(shards) <= 1:
+        return _lintel.loadvid_frame_nums(encoded_video,
+                                          frame_nums=frame_nums,
+                                          width=width,
+                                          height=height,
+                                          should_seek=should_seek,
+                                          hwaccel=hwaccel,
+                                          out=out,
+                                          num_threads=num_threads,
+                                          pix_fmt=pix_fmt,
+                                          dtype=dtype,
+                                          layout=layout,
+                                          mean=mean,
+                                          std=std)
+
+    is_size_dynamic = (width == 0) and (height == 0)
+    if is_size_dynamic:
+        width = video_width
+        height = video_height
+
+    frames = out
+    if frames is None:
+        frames = make_output_buffer(len(frame_nums),
+                                    height,
+                                    width,
+                                    dtype,
+                                    layout,
+                                    pix_fmt)
+    with concurrent.futures.ThreadPoolExecutor(len(shards)) as executor:
+        futures = [executor.submit(_lintel.loadvid_frame_nums_into,
+                                   encoded_video,
+                                   frames,
+                                   shard,
+                                   offset=offset,
+                                   width=width,
+                                   height=height,
+                                   hwaccel=hwaccel,
+                                   num_threads=num_threads,
+                                   pix_fmt=pix_fmt,
+                                   dtype=dtype,
+                                   layout=layout,
+                                   mean=mean,
+                                   std=std)
+                   for offset, shard in shards]
+        for future in futures:
+            future.result()
+
+    if num_decoded < len(frame_nums):
+        _loop_frames(frames,
+                     num_decoded,
+                     len(frame_nums),
+                     make_output_buffer(1,
+                                        height,
+                                        width,
+                                        dtype,
+                                        layout,
+                                        pix_fmt).nbytes)
+
+    if is_size_dynamic:
+        return frames, width, height
+
+    return frames
+
+
+def loadvid_frame_nums(encoded_video,
+                       *,
+                       frame_nums,
+                       width=0,
+                       height=0,
+                       should_seek=False,
+                       num_shards=1,
+                       hwaccel=None,
+                       out=None,
+                       num_threads=0,
+                       pix_fmt='rgb24',
+                       dtype='uint8',
+                       layout='NHWC',
+                       mean=None,
+                       std=None):
+    """Decodes the frames indexed by `frame_nums` from `encoded_video`.
+
+    See `_lintel.loadvid_frame_nums` for the meaning of the arguments and the
+    return value. Unlike `_lintel.loadvid_frame_nums`, `frame_nums` can be in
+    any order and contain repeats: the unique frames are decoded in increasing
+    order, and then gathered in the requested order. In that case, `out` must
+    be a numpy array, e.g., from `make_output_buffer`.
+
+    If `should_seek` is set and `num_shards` is greater than one, the frame
+    indices are split at keyframe boundaries into (at most) `num_shards` runs,
+    which are decoded concurrently (see `_loadvid_sorted_frame_nums`).
+
+    The decoded frames are returned as a numpy array of shape
+    (len(frame_nums), height, width, 3), or (len(frame_nums), 3, height, width)
+    if `layout` is 'NCHW', with elements of type `dtype`. See
+    `make_output_buffer` for the shapes of 'yuv420p' and 'gray' frames.
+    """
+    frame_nums, inverse = _normalize_frame_nums(frame_nums)
+    result = _loadvid_sorted_frame_nums(
+        encoded_video,
+        frame_nums=frame_nums,
+        width=width,
+        height=height,
+        should_seek=should_seek,
+        num_shards=num_shards,
+        hwaccel=hwaccel,
+        out=out if inverse is None else None,
+        num_threads=num_threads,
+        pix_fmt=pix_fmt,
+        dtype=dtype,
+        layout=layout,
+        mean=mean,
+        std=std)
+    if inverse is None:
+        return result
+
+    is_size_dynamic = (width == 0) and (height == 0)
+    return _gather_frames(result, inverse, out, is_size_dynamic)
@@ -14,16 +14,25 @@
  * limitations under the License.
  */
 #include "video_decode.h"
+#include <libavutil/cpu.h>
+#include <libavutil/hwcontext.h>
+#include <libavutil/pixdesc.h>
 #include <assert.h>
 #include <math.h>
 #include <stdio.h>
 #include <stdbool.h>
 #include <stdlib.h>
 #include <string.h>
+#if defined(__x86_64__) || defined(__i386__)
+#include <smmintrin.h>
+#define HAVE_STREAM_LOAD 1
+#endif
+
+#define UNUSED(x) x __attribute__ ((__unused__))
 
 /**
- * Receives a complete frame from the video stream in format_context that
- * corresponds to video_stream_index.
+ * Receives a complete frame, possibly still in a hardware surface, from the
+ * video stream in format_context that corresponds to video_stream_index.
  *
  * @param vid_ctx Context needed to decode frames from the video stream.
  *
@@ -31,7 +40,7 @@
  * VID_DECODE_FFMPEG_ERR if an FFmpeg error occurred..
  */
 static int32_t
-receive_frame(struct video_stream_context *vid_ctx)
+receive_decoded_frame(struct video_stream_context *vid_ctx)
 {
         AVPacket packet;
         int32_t status;
@@ -102,16 +111,221 @@ receive_frame(struct video_stream_context *vid_ctx)
         return VID_DECODE_EOF;
 }
 
+#ifdef HAVE_STREAM_LOAD
+/* NOTE(brendan): Size of the cached bounce buffer in `stream_load_copy`. */
+#define STREAM_LOAD_CHUNK_BYTES 4096
+
+/**
+ * Copies `size_bytes` from the 16-byte aligned `src` to `dest` using
+ * streaming loads (MOVNTDQA).
+ *
+ * Streaming loads read whole 64-byte lines from write-combining memory into
+ * fill buffers, instead of issuing one uncached read per load, which makes
+ * reading from USWC (e.g., mapped GPU surfaces) around an order of magnitude
+ * faster than with ordinary loads.
+ *
+ * The copy is done in 4 KB chunks: each chunk is first prefetched and
+ * stream-loaded into a small bounce buffer, which stays in cache, and only
+ * then copied out to `dest`. Interleaving the streaming loads with stores to
+ * `dest` would make the stores compete with the loads for fill buffers.
+ */
+__attribute__((target("sse4.1")))
+static void
+stream_load_copy(uint8_t *dest, const uint8_t *src, size_t size_bytes)
+{
+        __m128i bounce[STREAM_LOAD_CHUNK_BYTES/sizeof(__m128i)];
+        size_t offset = 0;
+        while ((offset + 64) <= size_bytes) {
+                size_t chunk_bytes = size_bytes - offset;
+                if (chunk_bytes > STREAM_LOAD_CHUNK_BYTES)
+                        chunk_bytes = STREAM_LOAD_CHUNK_BYTES;
+                chunk_bytes &= ~(size_t)63;
+
+                __m128i *src_lines = (__m128i *)(uintptr_t)(src + offset);
+                for (size_t line = 0;
+                     line < chunk_bytes;
+                     line += 64)
+                        _mm_prefetch((const char *)(src + offset + line),
+                                     _MM_HINT_NTA);
+
+                for (size_t i = 0;
+                     i < chunk_bytes/sizeof(__m128i);
+                     i += 4) {
+                        __m128i x0 = _mm_stream_load_si128(src_lines + i + 0);
+                        __m128i x1 = _mm_stream_load_si128(src_lines + i + 1);
+                        __m128i x2 = _mm_stream_load_si128(src_lines + i + 2);
+                        __m128i x3 = _mm_stream_load_si128(src_lines + i + 3);
+
+                        _mm_store_si128(bounce + i + 0, x0);
+                        _mm_store_si128(bounce + i + 1, x1);
+                        _mm_store_si128(bounce + i + 2, x2);
+                        _mm_store_si128(bounce + i + 3, x3);
+                }
+
+                memcpy(dest + offset, bounce, chunk_bytes);
+                offset += chunk_bytes;
+        }
+
+        memcpy(dest + offset, src + offset, size_bytes - offset);
+}
+#endif // HAVE_STREAM_LOAD
+
 /**
- * Allocates an RGB image frame.
+ * Copies `size_bytes` from `src`, which may be uncacheable speculative
+ * write-combining (USWC) memory, to the write-back memory at `dest`.
+ *
+ * Falls back to memcpy if SSE4.1 is not available, or `src` is not 16-byte
+ * aligned.
+ */
+static void
+copy_uswc_to_wb(uint8_t *dest, const uint8_t *src, size_t size_bytes)
+{
+#ifdef HAVE_STREAM_LOAD
+        if ((av_get_cpu_flags() & AV_CPU_FLAG_SSE4) &&
+            (((uintptr_t)src & 15) == 0)) {
+                stream_load_copy(dest, src, size_bytes);
+                return;
+        }
+#endif // HAVE_STREAM_LOAD
+
+        memcpy(dest, src, size_bytes);
+}
+
+/**
+ * Copies the mapped hardware surface `mapped` into `sw_frame`, row by row,
+ * with `copy_uswc_to_wb`.
+ *
+ * @return 0 on success, a negative AVERROR on failure.
+ */
+static int32_t
+copy_mapped_frame(AVFrame *sw_frame, const AVFrame *mapped)
+{
+        int32_t linesizes[4];
+        const AVPixFmtDescriptor *desc = av_pix_fmt_desc_get(mapped->format);
+        if (desc == NULL)
+                return AVERROR(EINVAL);
+
+        int32_t status = av_image_fill_linesizes(linesizes,
+                                                 mapped->format,
+                                                 mapped->width);
+        if (status < 0)
+                return status;
+
+        sw_frame->format = mapped->format;
+        sw_frame->width = mapped->width;
+        sw_frame->height = mapped->height;
+        status = av_frame_get_buffer(sw_frame, 32);
+        if (status < 0)
+                return status;
+
+        for (int32_t plane = 0;
+             (plane < 4) && (mapped->data[plane] != NULL);
+             ++plane) {
+                int32_t plane_height = mapped->height;
+                if ((plane == 1) || (plane == 2))
+                        plane_height = AV_CEIL_RSHIFT(mapped->height,
+                                                      desc->log2_chroma_h);
+
+                for (int32_t row = 0;
+                     row < plane_height;
+                     ++row) {
+                        copy_uswc_to_wb(sw_frame->data[plane] +
+                                        row*sw_frame->linesize[plane],
+                                        mapped->data[plane] +
+                                        row*mapped->linesize[plane],
+                                        linesizes[plane]);
+                }
+        }
+
+        return 0;
+}
+
+/**
+ * Replaces the hardware surface in `frame` with a copy in system memory.
+ *
+ * The surface is first mapped for reading, and copied with streaming loads,
+ * since mapped surfaces are typically USWC memory. If the hardware context
+ * does not support mapping, `av_hwframe_transfer_data` is used instead.
+ *
+ * @param frame Frame received from a hardware accelerated decoder.
+ *
+ * @return VID_DECODE_SUCCESS on success, VID_DECODE_FFMPEG_ERR on failure.
+ */
+static int32_t
+download_hw_frame(AVFrame *frame)
+{
+        int32_t status;
+        AVFrame *sw_frame = av_frame_alloc();
+        if (sw_frame == NULL)
+                return VID_DECODE_FFMPEG_ERR;
+
+        AVFrame *mapped = av_frame_alloc();
+        if (mapped == NULL)
+                goto out_free_sw_frame;
+
+        status = av_hwframe_map(mapped, frame, AV_HWFRAME_MAP_READ);
+        if (status == 0) {
+                status = copy_mapped_frame(sw_frame, mapped);
+                if (status < 0)
+                        av_frame_unref(sw_frame);
+        }
+        av_frame_free(&mapped);
+
+        if (status < 0) {
+                status = av_hwframe_transfer_data(sw_frame, frame, 0);
+                if (status < 0)
+                        goto out_free_sw_frame;
+        }
+
+        status = av_frame_copy_props(sw_frame, frame);
+        if (status < 0)
+                goto out_free_sw_frame;
+
+        av_frame_unref(frame);
+        av_frame_move_ref(frame, sw_frame);
+        av_frame_free(&sw_frame);
+
+        return VID_DECODE_SUCCESS;
+
+out_free_sw_frame:
+        av_frame_free(&sw_frame);
+
+        return VID_DECODE_FFMPEG_ERR;
+}
+
+/**
+ * Receives a complete frame from the video stream in format_context that
+ * corresponds to video_stream_index.
+ *
+ * Frames decoded to hardware surfaces are downloaded to system memory.
+ *
+ * @param vid_ctx Context needed to decode frames from the video stream.
+ *
+ * @return SUCCESS on success, VID_DECODE_EOF if no frame was received, and
+ * VID_DECODE_FFMPEG_ERR if an FFmpeg error occurred..
+ */
+static int32_t
+receive_frame(struct video_stream_context *vid_ctx)
+{
+        int32_t status = receive_decoded_frame(vid_ctx);
+        if ((status != VID_DECODE_SUCCESS) ||
+            (vid_ctx->frame->hw_frames_ctx == NULL))
+                return status;
+
+        return download_hw_frame(vid_ctx->frame);
+}
+
+/**
+ * Allocates an image frame.
  *
  * @param codec_context Decoder context from the video stream, from which the
- * RGB frame will get its dimensions.
+ * frame will get its dimensions.
+ * @param format Pixel format of the frame.
  *
- * @return The allocated RGB frame on success, NULL on failure.
+ * @return The allocated frame on success, NULL on failure.
  */
 static AVFrame *
-allocate_rgb_image(AVCodecContext *codec_context)
+allocate_image(AVCodecContext *codec_context, enum AVPixelFormat format)
 {
         int32_t status;
         AVFrame *frame_rgb;
@@ -120,7 +334,7 @@ allocate_rgb_image(AVCodecContext *codec_context)
         if (frame_rgb == NULL)
                 return NULL;
 
-        frame_rgb->format = AV_PIX_FMT_RGB24;
+        frame_rgb->format = format;
         frame_rgb->width = codec_context->width;
         frame_rgb->height = codec_context->height;
 
@@ -128,7 +342,7 @@ allocate_rgb_image(AVCodecContext *codec_context)
                                 frame_rgb->linesize,
                                 frame_rgb->width,
                                 frame_rgb->height,
-                                AV_PIX_FMT_RGB24,
+                                format,
                                 32);
         if (status < 0) {
                 av_frame_free(&frame_rgb);
@@ -139,29 +353,339 @@ allocate_rgb_image(AVCodecContext *codec_context)
 }
 
 /**
- * Copies the received frame in `frame` to `dest`, using `frame_rgb` as
- * temporary storage for `sws_scale`.
+ * Converts `value` to an IEEE 754 half precision float, rounding to nearest
+ * even.
  *
- * @param dest Destination buffer for RGB24 frame.
- * @param frame Received frame.
- * @param frame_rgb Temporary RGB frame.
- * @param sws_context Context to use for sws_scale operation.
- * @param copied_bytes Number of bytes already copied into dest from the video.
- * @param bytes_per_row Number of bytes per row in the video.
+ * @param value Single precision float to convert.
  *
- * @return Number of bytes copied to `dest`, including the frame copied over by
- * this function.
+ * @return The bits of the half precision float.
  */
-static uint32_t
-copy_next_frame(uint8_t *dest,
-                AVFrame *frame,
-                AVFrame *frame_rgb,
-                AVCodecContext *codec_context,
-                struct SwsContext *sws_context,
-                uint32_t copied_bytes,
-                const uint32_t bytes_per_row)
-{
-        sws_scale(sws_context,
+static uint16_t
+float_to_half(float value)
+{
+        uint32_t bits;
+        memcpy(&bits, &value, sizeof(bits));
+
+        uint16_t sign = (bits >> 16) & 0x8000;
+        int32_t exponent = (int32_t)((bits >> 23) & 0xff) - 127 + 15;
+        uint32_t mantissa = bits & 0x7fffff;
+
+        if ((bits & 0x7fffffff) > 0x7f800000)
+                return sign | 0x7e00;
+        if (exponent >= 0x1f)
+                return sign | 0x7c00;
+
+        uint32_t shift = 13;
+        if (exponent <= 0) {
+                /* NOTE(brendan): Too small even for a subnormal half. */
+                if (exponent < -10)
+                        return sign;
+
+                mantissa |= 0x800000;
+                shift = 14 - exponent;
+                exponent = 0;
+        }
+
+        uint32_t half = (exponent << 10) | (mantissa >> shift);
+        uint32_t remainder = mantissa & ((1u << shift) - 1);
+        uint32_t halfway = 1u << (shift - 1);
+        /**
+         * NOTE(brendan): A carry out of the mantissa correctly increments the
+         * exponent, up to infinity.
+         */
+        if ((remainder > halfway) || ((remainder == halfway) && (half & 1)))
+                ++half;
+
+        return sign | half;
+}
+
+/**
+ * Converts `value` to a bfloat16, rounding to nearest even.
+ *
+ * @param value Single precision float to convert.
+ *
+ * @return The bits of the bfloat16.
+ */
+static uint16_t
+float_to_bfloat16(float value)
+{
+        uint32_t bits;
+        memcpy(&bits, &value, sizeof(bits));
+
+        if ((bits & 0x7fffffff) > 0x7f800000)
+                return (bits >> 16) | 0x40;
+
+        bits += 0x7fff + ((bits >> 16) & 1);
+
+        return bits >> 16;
+}
+
+/**
+ * NOTE(brendan): The row conversion kernels below convert one row of `width`
+ * RGB24 pixels from `src` to the output format, writing to `dest_rows[0]` for
+ * interleaved (NHWC) output, or splitting the row into the R, G and B plane
+ * rows `dest_rows[0..2]` for planar (NCHW) output. Values are converted by
+ * looking them up in the output format's per-channel tables.
+ *
+ * There is one kernel per layout and element size, so that the inner loops
+ * have no per-pixel or per-row branches on the output format. The kernel is
+ * selected once per output format, by `set_out_format`.
+ */
+
+static void
+convert_row_nhwc_uint8(uint8_t *dest_rows[3],
+                       const uint8_t *src,
+                       int32_t width,
+                       const struct out_format *UNUSED(out_format))
+{
+        memcpy(dest_rows[0], src, 3*width);
+}
+
+static void
+convert_row_nhwc_float32(uint8_t *dest_rows[3],
+                         const uint8_t *src,
+                         int32_t width,
+                         const struct out_format *out_format)
+{
+        const float (*lut)[256] = out_format->lut.f32;
+        float *dest = (float *)dest_rows[0];
+        for (int32_t i = 0;
+             i < 3*width;
+             i += 3) {
+                dest[i] = lut[0][src[i]];
+                dest[i + 1] = lut[1][src[i + 1]];
+                dest[i + 2] = lut[2][src[i + 2]];
+        }
+}
+
+static void
+convert_row_nhwc_16(uint8_t *dest_rows[3],
+                    const uint8_t *src,
+                    int32_t width,
+                    const struct out_format *out_format)
+{
+        const uint16_t (*lut)[256] = out_format->lut.f16;
+        uint16_t *dest = (uint16_t *)dest_rows[0];
+        for (int32_t i = 0;
+             i < 3*width;
+             i += 3) {
+                dest[i] = lut[0][src[i]];
+                dest[i + 1] = lut[1][src[i + 1]];
+                dest[i + 2] = lut[2][src[i + 2]];
+        }
+}
+
+static void
+convert_row_nchw_uint8(uint8_t *dest_rows[3],
+                       const uint8_t *src,
+                       int32_t width,
+                       const struct out_format *UNUSED(out_format))
+{
+        uint8_t *dest_r = dest_rows[0];
+        uint8_t *dest_g = dest_rows[1];
+        uint8_t *dest_b = dest_rows[2];
+        for (int32_t i = 0;
+             i < width;
+             ++i) {
+                dest_r[i] = src[3*i];
+                dest_g[i] = src[3*i + 1];
+                dest_b[i] = src[3*i + 2];
+        }
+}
+
+static void
+convert_row_nchw_float32(uint8_t *dest_rows[3],
+                         const uint8_t *src,
+                         int32_t width,
+                         const struct out_format *out_format)
+{
+        const float (*lut)[256] = out_format->lut.f32;
+        float *dest_r = (float *)dest_rows[0];
+        float *dest_g = (float *)dest_rows[1];
+        float *dest_b = (float *)dest_rows[2];
+        for (int32_t i = 0;
+             i < width;
+             ++i) {
+                dest_r[i] = lut[0][src[3*i]];
+                dest_g[i] = lut[1][src[3*i + 1]];
+                dest_b[i] = lut[2][src[3*i + 2]];
+        }
+}
+
+static void
+convert_row_nchw_16(uint8_t *dest_rows[3],
+                    const uint8_t *src,
+                    int32_t width,
+                    const struct out_format *out_format)
+{
+        const uint16_t (*lut)[256] = out_format->lut.f16;
+        uint16_t *dest_r = (uint16_t *)dest_rows[0];
+        uint16_t *dest_g = (uint16_t *)dest_rows[1];
+        uint16_t *dest_b = (uint16_t *)dest_rows[2];
+        for (int32_t i = 0;
+             i < width;
+             ++i) {
+                dest_r[i] = lut[0][src[3*i]];
+                dest_g[i] = lut[1][src[3*i + 1]];
+                dest_b[i] = lut[2][src[3*i + 2]];
+        }
+}
+
+/**
+ * NOTE(brendan): Row conversion kernels, indexed by layout and dtype. float16
+ * and bfloat16 share kernels, since their tables have the same element size.
+ */
+static const convert_row_fn convert_row_kernels[2][4] = {
+        [OUT_LAYOUT_NHWC] = {
+                [OUT_DTYPE_UINT8] = convert_row_nhwc_uint8,
+                [OUT_DTYPE_FLOAT32] = convert_row_nhwc_float32,
+                [OUT_DTYPE_FLOAT16] = convert_row_nhwc_16,
+                [OUT_DTYPE_BFLOAT16] = convert_row_nhwc_16,
+        },
+        [OUT_LAYOUT_NCHW] = {
+                [OUT_DTYPE_UINT8] = convert_row_nchw_uint8,
+                [OUT_DTYPE_FLOAT32] = convert_row_nchw_float32,
+                [OUT_DTYPE_FLOAT16] = convert_row_nchw_16,
+                [OUT_DTYPE_BFLOAT16] = convert_row_nchw_16,
+        },
+};
+
+void
+set_out_format(struct out_format *out_format,
+               enum out_pix_fmt pix_fmt,
+               enum out_dtype dtype,
+               enum out_layout layout,
+               const float mean[3],
+               const float std[3])
+{
+        out_format->pix_fmt = pix_fmt;
+        out_format->dtype = dtype;
+        out_format->layout = layout;
+        out_format->convert_row = convert_row_kernels[layout][dtype];
+        if (dtype == OUT_DTYPE_UINT8)
+                return;
+
+        for (int32_t channel = 0;
+             channel < 3;
+             ++channel) {
+                for (int32_t value = 0;
+                     value < 256;
+                     ++value) {
+                        float normalized =
+                                (value/255.0f - mean[channel])/std[channel];
+
+                        if (dtype == OUT_DTYPE_FLOAT32)
+                                out_format->lut.f32[channel][value] =
+                                        normalized;
+                        else if (dtype == OUT_DTYPE_FLOAT16)
+                                out_format->lut.f16[channel][value] =
+                                        float_to_half(normalized);
+                        else
+                                out_format->lut.f16[channel][value] =
+                                        float_to_bfloat16(normalized);
+                }
+        }
+}
+
+size_t
+out_frame_size(const struct out_format *out_format,
+               uint32_t width,
+               uint32_t height)
+{
+        const size_t num_pixels = (size_t)width*height;
+
+        switch (out_format->pix_fmt) {
+        case OUT_PIX_FMT_YUV420P:
+                return num_pixels +
+                       2*(size_t)((width + 1)/2)*((height + 1)/2);
+        case OUT_PIX_FMT_GRAY:
+                return num_pixels;
+        case OUT_PIX_FMT_RGB24:
+        default:
+                return 3*num_pixels*out_dtype_size(out_format->dtype);
+        }
+}
+
+uint32_t out_dtype_size(enum out_dtype dtype)
+{
+        switch (dtype) {
+        case OUT_DTYPE_FLOAT32:
+                return sizeof(float);
+        case OUT_DTYPE_FLOAT16:
+        case OUT_DTYPE_BFLOAT16:
+                return sizeof(uint16_t);
+        case OUT_DTYPE_UINT8:
+        default:
+                return sizeof(uint8_t);
+        }
+}
+
+/**
+ * Gets the conversion context from the received frame's pixel format to
+ * `dest_format`.
+ *
+ * The conversion context is cached in `vid_ctx->sws_context`, and only
+ * recreated if the received frame's format (or `dest_format`) changes.
+ *
+ * @param vid_ctx Context with the received frame.
+ * @param dest_format Pixel format to convert to.
+ *
+ * @return The conversion context.
+ */
+static struct SwsContext *
+get_sws_context(struct video_stream_context *vid_ctx,
+                enum AVPixelFormat dest_format)
+{
+        AVCodecContext *codec_context = vid_ctx->codec_context;
+
+        /**
+         * NOTE(brendan): The source pixel format is taken from the frame
+         * rather than the codec context, because frames downloaded from
+         * hardware surfaces (e.g., NV12) do not have the codec context's
+         * (hardware) pixel format.
+         */
+        vid_ctx->sws_context = sws_getCachedContext(vid_ctx->sws_context,
+                                                    codec_context->width,
+                                                    codec_context->height,
+                                                    vid_ctx->frame->format,
+                                                    codec_context->width,
+                                                    codec_context->height,
+                                                    dest_format,
+                                                    SWS_BILINEAR,
+                                                    NULL,
+                                                    NULL,
+                                                    NULL);
+        assert(vid_ctx->sws_context != NULL);
+
+        return vid_ctx->sws_context;
+}
+
+/**
+ * Converts the received frame in `vid_ctx->frame` to `dest_format`, in the
+ * padded staging frame `vid_ctx->frame_rgb`, which is allocated on first use.
+ *
+ * @param vid_ctx Context with the received frame.
+ * @param dest_format Pixel format to convert to, which must be the same for
+ * every frame converted with `vid_ctx`.
+ *
+ * @return The staging frame.
+ */
+static AVFrame *
+convert_to_staging_frame(struct video_stream_context *vid_ctx,
+                         enum AVPixelFormat dest_format)
+{
+        AVCodecContext *codec_context = vid_ctx->codec_context;
+        AVFrame *frame = vid_ctx->frame;
+
+        if (vid_ctx->frame_rgb == NULL) {
+                vid_ctx->frame_rgb = allocate_image(codec_context,
+                                                    dest_format);
+                assert(vid_ctx->frame_rgb != NULL);
+        }
+        AVFrame *frame_rgb = vid_ctx->frame_rgb;
+        assert(frame_rgb->format == dest_format);
+
+        sws_scale(get_sws_context(vid_ctx, dest_format),
                   (const uint8_t * const *)(frame->data),
                   frame->linesize,
                   0,
@@ -169,34 +693,226 @@ copy_next_frame(uint8_t *dest,
                   frame_rgb->data,
                   frame_rgb->linesize);
 
+        return frame_rgb;
+}
+
+/**
+ * Converts the received frame in `vid_ctx->frame` to RGB, and copies it to
+ * `dest` in the format given by `vid_ctx->out_format`.
+ *
+ * @param dest Destination of the RGB frame.
+ * @param vid_ctx Context with the received frame.
+ * @param bytes_per_row Number of bytes per row in the output format.
+ */
+static void
+copy_rgb_frame(uint8_t *dest,
+               struct video_stream_context *vid_ctx,
+               const uint32_t bytes_per_row)
+{
+        AVCodecContext *codec_context = vid_ctx->codec_context;
+        AVFrame *frame = vid_ctx->frame;
+        const struct out_format *out_format = vid_ctx->out_format;
+        const bool is_planar = (out_format->layout == OUT_LAYOUT_NCHW);
+        const uint32_t bytes_per_plane_row = bytes_per_row/3;
+
+        /**
+         * NOTE(brendan): R, G and B planes of the frame in `dest`, for planar
+         * output.
+         */
+        const uint32_t bytes_per_plane =
+                codec_context->height*bytes_per_plane_row;
+        uint8_t *planes[3] = {dest,
+                              dest + bytes_per_plane,
+                              dest + 2*bytes_per_plane};
+
+        /**
+         * NOTE(brendan): swscale's SIMD converters work on blocks of pixels,
+         * and expect rows to be aligned and padded. If the row width is a
+         * multiple of 16 pixels, rows in `dest` are both, so convert uint8
+         * output directly into `dest`. Otherwise, or for other output types,
+         * convert into a padded staging frame and convert the rows over while
+         * they are still in cache.
+         */
+        const bool is_direct = (out_format->dtype == OUT_DTYPE_UINT8) &&
+                               ((codec_context->width % 16) == 0);
+        if (is_direct) {
+                enum AVPixelFormat dest_format = AV_PIX_FMT_RGB24;
+                uint8_t *dest_data[4] = {dest, NULL, NULL, NULL};
+                int32_t dest_linesize[4] = {bytes_per_row, 0, 0, 0};
+                if (is_planar) {
+                        /* NOTE(brendan): GBRP planes are in G, B, R order. */
+                        dest_format = AV_PIX_FMT_GBRP;
+                        dest_data[0] = planes[1];
+                        dest_data[1] = planes[2];
+                        dest_data[2] = planes[0];
+                        for (int32_t i = 0;
+                             i < 3;
+                             ++i)
+                                dest_linesize[i] = bytes_per_plane_row;
+                }
+
+                sws_scale(get_sws_context(vid_ctx, dest_format),
+                          (const uint8_t * const *)(frame->data),
+                          frame->linesize,
+                          0,
+                          codec_context->height,
+                          dest_data,
+                          dest_linesize);
+
+                return;
+        }
+
+        AVFrame *frame_rgb = convert_to_staging_frame(vid_ctx,
+                                                      AV_PIX_FMT_RGB24);
+
+        uint8_t *dest_rows[3] = {dest, dest, dest};
+        uint32_t dest_row_stride = bytes_per_row;
+        if (is_planar) {
+                memcpy(dest_rows, planes, sizeof(dest_rows));
+                dest_row_stride = bytes_per_plane_row;
+        }
+
+        const convert_row_fn convert_row = out_format->convert_row;
         uint8_t *next_row = frame_rgb->data[0];
         for (int32_t row_index = 0;
              row_index < frame_rgb->height;
              ++row_index) {
-                memcpy(dest + copied_bytes, next_row, bytes_per_row);
+                convert_row(dest_rows, next_row, frame_rgb->width, out_format);
 
+                for (int32_t i = 0;
+                     i < 3;
+                     ++i)
+                        dest_rows[i] += dest_row_stride;
                 next_row += frame_rgb->linesize[0];
-                copied_bytes += bytes_per_row;
+        }
+}
+
+/**
+ * Copies the received frame in `vid_ctx->frame` to `dest` as YUV420P, i.e.,
+ * the Y plane followed by the U and V planes.
+ *
+ * @param dest Destination of the YUV420P frame.
+ * @param vid_ctx Context with the received frame.
+ * @param bytes_per_frame Size of the YUV420P frame in bytes.
+ */
+static void
+copy_yuv420p_frame(uint8_t *dest,
+                   struct video_stream_context *vid_ctx,
+                   const size_t bytes_per_frame)
+{
+        AVCodecContext *codec_context = vid_ctx->codec_context;
+        AVFrame *frame = vid_ctx->frame;
+
+        /**
+         * NOTE(brendan): Most H.264 and VP9 video is decoded to YUV420P (or
+         * its full range variant YUVJ420P) already, in which case the planes
+         * are copied out of the decoded frame as is, skipping swscale.
+         */
+        if ((frame->format != AV_PIX_FMT_YUV420P) &&
+            (frame->format != AV_PIX_FMT_YUVJ420P))
+                frame = convert_to_staging_frame(vid_ctx, AV_PIX_FMT_YUV420P);
+
+        int32_t status =
+                av_image_copy_to_buffer(dest,
+                                        bytes_per_frame,
+                                        (const uint8_t * const *)frame->data,
+                                        frame->linesize,
+                                        AV_PIX_FMT_YUV420P,
+                                        codec_context->width,
+                                        codec_context->height,
+                                        1);
+        assert(status >= 0);
+}
+
+/**
+ * Copies the luma of the received frame in `vid_ctx->frame` to `dest`, as an
+ * 8-bit grayscale image.
+ *
+ * @param dest Destination of the grayscale frame.
+ * @param vid_ctx Context with the received frame.
+ */
+static void
+copy_gray_frame(uint8_t *dest, struct video_stream_context *vid_ctx)
+{
+        AVCodecContext *codec_context = vid_ctx->codec_context;
+        AVFrame *frame = vid_ctx->frame;
+
+        /**
+         * NOTE(brendan): The first plane of 8-bit planar and semi-planar
+         * (e.g., NV12) YUV formats is the luma plane, which is copied out of
+         * the decoded frame as is, skipping swscale.
+         */
+        const AVPixFmtDescriptor *desc = av_pix_fmt_desc_get(frame->format);
+        bool is_luma_plane = (desc != NULL) &&
+                             !(desc->flags & (AV_PIX_FMT_FLAG_RGB |
+                                              AV_PIX_FMT_FLAG_PAL)) &&
+                             (desc->comp[0].plane == 0) &&
+                             (desc->comp[0].step == 1) &&
+                             (desc->comp[0].depth == 8);
+        if (!is_luma_plane)
+                frame = convert_to_staging_frame(vid_ctx, AV_PIX_FMT_GRAY8);
+
+        av_image_copy_plane(dest,
+                            codec_context->width,
+                            frame->data[0],
+                            frame->linesize[0],
+                            codec_context->width,
+                            codec_context->height);
+}
+
+/**
+ * Copies the received frame in `vid_ctx->frame` to `dest`, in the format given
+ * by `vid_ctx->out_format`.
+ *
+ * @param dest Destination buffer for decoded frames.
+ * @param vid_ctx Context with the received frame.
+ * @param copied_bytes Number of bytes already copied into dest from the video.
+ * @param bytes_per_frame Number of bytes per frame in the output format.
+ *
+ * @return Number of bytes copied to `dest`, including the frame copied over by
+ * this function.
+ */
+static size_t
+copy_next_frame(uint8_t *dest,
+                struct video_stream_context *vid_ctx,
+                size_t copied_bytes,
+                const size_t bytes_per_frame)
+{
+        uint8_t *frame_dest = dest + copied_bytes;
+
+        switch (vid_ctx->out_format->pix_fmt) {
+        case OUT_PIX_FMT_YUV420P:
+                copy_yuv420p_frame(frame_dest, vid_ctx, bytes_per_frame);
+                break;
+        case OUT_PIX_FMT_GRAY:
+                copy_gray_frame(frame_dest, vid_ctx);
+                break;
+        case OUT_PIX_FMT_RGB24:
+        default:
+                copy_rgb_frame(frame_dest,
+                               vid_ctx,
+                               bytes_per_frame/vid_ctx->codec_context->height);
+                break;
         }
 
-        return copied_bytes;
+        return copied_bytes + bytes_per_frame;
 }
 
 /**
  * Loops the frames already received in `dest` until the `num_requested_frames`
  * have been satisfied.
  *
- * @param dest Output RGB24 frame buffer.
+ * @param dest Output RGB frame buffer.
  * @param copied_bytes Number of bytes already copied into `dest`.
  * @param frame_number The number of the next frame to copy into `dest`.
- * @param bytes_per_frame The number of bytes per frame (3*width*height).
+ * @param bytes_per_frame The number of bytes per frame in the output format.
  * @param num_requested_frames The number of frames that were requested.
  */
 static void
 loop_to_buffer_end(uint8_t *dest,
-                   uint32_t copied_bytes,
+                   size_t copied_bytes,
                    int32_t frame_number,
-                   uint32_t bytes_per_frame,
+                   size_t bytes_per_frame,
                    int32_t num_requested_frames)
 {
         fprintf(stderr, "Ran out of frames. Looping.\n");
@@ -205,11 +921,12 @@ loop_to_buffer_end(uint8_t *dest,
                 return;
         }
 
-        uint32_t bytes_to_copy = copied_bytes;
+        size_t bytes_to_copy = copied_bytes;
         int32_t remaining_frames = (num_requested_frames - frame_number);
         while (remaining_frames > 0) {
                 if (remaining_frames < frame_number)
-                        bytes_to_copy = remaining_frames*bytes_per_frame;
+                        bytes_to_copy =
+                                (size_t)remaining_frames*bytes_per_frame;
 
                 memcpy(dest + copied_bytes, dest, bytes_to_copy);
 
@@ -224,24 +941,10 @@ decode_video_to_out_buffer(uint8_t *dest,
                            int32_t num_requested_frames)
 {
         AVCodecContext *codec_context = vid_ctx->codec_context;
-        struct SwsContext *sws_context = sws_getContext(codec_context->width,
-                                                        codec_context->height,
-                                                        codec_context->pix_fmt,
-                                                        codec_context->width,
-                                                        codec_context->height,
-                                                        AV_PIX_FMT_RGB24,
-                                                        SWS_BILINEAR,
-                                                        NULL,
-                                                        NULL,
-                                                        NULL);
-        assert(sws_context != NULL);
-
-        AVFrame *frame_rgb = allocate_rgb_image(codec_context);
-        assert(frame_rgb != NULL);
-
-        const uint32_t bytes_per_row = 3*frame_rgb->width;
-        const uint32_t bytes_per_frame = bytes_per_row*frame_rgb->height;
-        uint32_t copied_bytes = 0;
+        const size_t bytes_per_frame = out_frame_size(vid_ctx->out_format,
+                                                      codec_context->width,
+                                                      codec_context->height);
+        size_t copied_bytes = 0;
         for (int32_t frame_number = 0;
              frame_number < num_requested_frames;
              ++frame_number) {
@@ -257,24 +960,16 @@ decode_video_to_out_buffer(uint8_t *dest,
                 assert(status == VID_DECODE_SUCCESS);
 
                 copied_bytes = copy_next_frame(dest,
-                                               vid_ctx->frame,
-                                               frame_rgb,
-                                               codec_context,
-                                               sws_context,
+                                               vid_ctx,
                                                copied_bytes,
-                                               bytes_per_row);
+                                               bytes_per_frame);
         }
-
-        av_freep(frame_rgb->data);
-        av_frame_free(&frame_rgb);
-
-        sws_freeContext(sws_context);
 }
 
 int32_t read_memory(void *opaque, uint8_t *buffer, int32_t buf_size_bytes)
 {
         struct buffer_data *input_buf = (struct buffer_data *)opaque;
-        int32_t bytes_remaining = (input_buf->total_size_bytes -
+        int64_t bytes_remaining = (input_buf->total_size_bytes -
                                    input_buf->offset_bytes);
         if (bytes_remaining < buf_size_bytes)
                 buf_size_bytes = bytes_remaining;
@@ -291,7 +986,7 @@ int32_t read_memory(void *opaque, uint8_t *buffer, int32_t buf_size_bytes)
 int64_t seek_memory(void *opaque, int64_t offset64, int32_t whence)
 {
         struct buffer_data *input_buf = (struct buffer_data *)opaque;
-        int32_t offset = (int32_t)offset64;
+        int64_t offset = offset64;
 
         switch (whence) {
         case SEEK_CUR:
@@ -406,7 +1101,94 @@ setup_format_context(AVFormatContext **format_context_ptr,
         return find_video_stream_index(format_context);
 }
 
-AVCodecContext *open_video_codec_ctx(AVStream *video_stream)
+/**
+ * Finds the pixel format of frames that `codec` decodes to with a hardware
+ * device of type `hw_device_type`.
+ *
+ * @return The hardware pixel format, or AV_PIX_FMT_NONE if `codec` does not
+ * support decoding with `hw_device_type`.
+ */
+static enum AVPixelFormat
+find_hw_pix_fmt(const AVCodec *codec, enum AVHWDeviceType hw_device_type)
+{
+        for (int32_t i = 0;
+             ;
+             ++i) {
+                const AVCodecHWConfig *config = avcodec_get_hw_config(codec, i);
+                if (config == NULL)
+                        return AV_PIX_FMT_NONE;
+
+                if ((config->methods & AV_CODEC_HW_CONFIG_METHOD_HW_DEVICE_CTX) &&
+                    (config->device_type == hw_device_type))
+                        return config->pix_fmt;
+        }
+}
+
+/**
+ * get_format callback that picks the hardware pixel format stored in
+ * `codec_context->opaque`, if offered by the decoder.
+ */
+static enum AVPixelFormat
+get_hw_format(AVCodecContext *codec_context,
+              const enum AVPixelFormat *pix_fmts)
+{
+        enum AVPixelFormat hw_pix_fmt =
+                (enum AVPixelFormat)(intptr_t)codec_context->opaque;
+
+        for (const enum AVPixelFormat *pix_fmt = pix_fmts;
+             *pix_fmt != AV_PIX_FMT_NONE;
+             ++pix_fmt) {
+                if (*pix_fmt == hw_pix_fmt)
+                        return *pix_fmt;
+        }
+
+        fprintf(stderr, "Hardware pixel format not offered by decoder.\n");
+
+        return avcodec_default_get_format(codec_context, pix_fmts);
+}
+
+/**
+ * Attaches a newly created hardware device of type `hw_device_type` to
+ * `codec_context`, and installs a get_format callback that selects the
+ * device's pixel format.
+ *
+ * @return true if the device was attached, false if decoding should fall back
+ * to software.
+ */
+static bool
+setup_hw_device(AVCodecContext *codec_context,
+                const AVCodec *video_codec,
+                enum AVHWDeviceType hw_device_type)
+{
+        enum AVPixelFormat hw_pix_fmt = find_hw_pix_fmt(video_codec,
+                                                        hw_device_type);
+        if (hw_pix_fmt == AV_PIX_FMT_NONE)
+                return false;
+
+        AVBufferRef *hw_device_ctx = NULL;
+        int32_t status = av_hwdevice_ctx_create(&hw_device_ctx,
+                                                hw_device_type,
+                                                NULL,
+                                                NULL,
+                                                0);
+        if (status < 0)
+                return false;
+
+        codec_context->hw_device_ctx = av_buffer_ref(hw_device_ctx);
+        av_buffer_unref(&hw_device_ctx);
+        if (codec_context->hw_device_ctx == NULL)
+                return false;
+
+        codec_context->opaque = (void *)(intptr_t)hw_pix_fmt;
+        codec_context->get_format = get_hw_format;
+
+        return true;
+}
+
+AVCodecContext *
+open_video_codec_ctx(AVStream *video_stream,
+                     enum AVHWDeviceType hw_device_type,
+                     uint32_t num_threads)
 {
         int32_t status;
         AVCodecContext *codec_context;
@@ -427,6 +1209,29 @@ AVCodecContext *open_video_codec_ctx(AVStream *video_stream)
                 return NULL;
         }
 
+        bool is_hw_decoding = false;
+        if (hw_device_type != AV_HWDEVICE_TYPE_NONE) {
+                is_hw_decoding = setup_hw_device(codec_context,
+                                                 video_codec,
+                                                 hw_device_type);
+                if (!is_hw_decoding)
+                        fprintf(stderr,
+                                "Hardware decoding unavailable, using software.\n");
+        }
+
+        /**
+         * NOTE(brendan): Only request threading types that the decoder
+         * supports, and avoid frame threading with hardware decoding, where
+         * some FFmpeg versions deadlock or fail.
+         */
+        codec_context->thread_count = num_threads;
+        codec_context->thread_type = 0;
+        if ((video_codec->capabilities & AV_CODEC_CAP_FRAME_THREADS) &&
+            !is_hw_decoding)
+                codec_context->thread_type |= FF_THREAD_FRAME;
+        if (video_codec->capabilities & AV_CODEC_CAP_SLICE_THREADS)
+                codec_context->thread_type |= FF_THREAD_SLICE;
+
         status = avcodec_open2(codec_context, video_codec, NULL);
         if (status != 0) {
                 avcodec_free_context(&codec_context);
@@ -522,6 +1327,174 @@ skip_past_timestamp(struct video_stream_context *vid_ctx, int64_t timestamp)
         return VID_DECODE_SUCCESS;
 }
 
+int32_t
+rewind_video_stream(struct video_stream_context *vid_ctx)
+{
+        AVStream *video_stream =
+                vid_ctx->format_context->streams[vid_ctx->video_stream_index];
+        int64_t start_time = 0;
+        if (video_stream->start_time != AV_NOPTS_VALUE)
+                start_time = video_stream->start_time;
+
+        int32_t status = av_seek_frame(vid_ctx->format_context,
+                                       vid_ctx->video_stream_index,
+                                       start_time,
+                                       AVSEEK_FLAG_BACKWARD);
+        if (status < 0)
+                return VID_DECODE_FFMPEG_ERR;
+
+        avcodec_flush_buffers(vid_ctx->codec_context);
+
+        return VID_DECODE_SUCCESS;
+}
+
+/**
+ * get_reorder_delay() - Gets the (approximate) difference between the PTS and
+ * the DTS of the keyframes in the video stream, in video stream time base
+ * units.
+ * @vid_ctx: Context with the video stream.
+ * @avg_frame_duration: Average frame duration, in video stream time base
+ * units.
+ *
+ * NOTE(brendan): Some containers, e.g., MP4, index keyframes (and seek) by
+ * DTS, while frame numbers are computed from PTS. With B-frames, a keyframe's
+ * DTS is earlier than its PTS by the number of frames of reordering delay of
+ * the codec. For containers indexed by PTS this overestimates keyframe PTS,
+ * which only makes seeks land on an earlier keyframe.
+ */
+static int64_t
+get_reorder_delay(struct video_stream_context *vid_ctx,
+                  int32_t avg_frame_duration)
+{
+        AVStream *video_stream =
+                vid_ctx->format_context->streams[vid_ctx->video_stream_index];
+
+        return video_stream->codecpar->video_delay*(int64_t)avg_frame_duration;
+}
+
+/**
+ * seek_to_frame_num() - Seeks to the closest keyframe at or before
+ * `frame_num`, and receives the first frame from there.
+ * @vid_ctx: Context needed to decode frames from the video stream.
+ * @frame_num: Frame number to seek to.
+ * @avg_frame_duration: Average frame duration, in video stream time base
+ * units, used to convert between frame numbers and timestamps.
+ * @frame_index_out: Output (approximate) frame number of the received frame.
+ *
+ * The decoder is flushed after seeking, so this can be used to seek forward
+ * in the middle of decoding.
+ *
+ * Returns the status of receiving the first frame after the seek.
+ */
+static int32_t
+seek_to_frame_num(struct video_stream_context *vid_ctx,
+                  int32_t frame_num,
+                  int32_t avg_frame_duration,
+                  int32_t *frame_index_out)
+{
+        int64_t timestamp = (frame_num*(int64_t)avg_frame_duration -
+                             get_reorder_delay(vid_ctx, avg_frame_duration));
+        if (timestamp < 0)
+                timestamp = 0;
+
+        int32_t status = av_seek_frame(vid_ctx->format_context,
+                                       vid_ctx->video_stream_index,
+                                       timestamp,
+                                       AVSEEK_FLAG_BACKWARD);
+        assert(status >= 0);
+
+        avcodec_flush_buffers(vid_ctx->codec_context);
+
+        status = receive_frame(vid_ctx);
+        if (status != VID_DECODE_SUCCESS)
+                return status;
+
+        *frame_index_out = vid_ctx->frame->pts/avg_frame_duration;
+
+        return VID_DECODE_SUCCESS;
+}
+
+/**
+ * seek_at_or_before_frame_num() - Seeks to a keyframe at or before
+ * `frame_num`, like `seek_to_frame_num`, but retries further back if the seek
+ * overshoots `frame_num`.
+ * @vid_ctx: Context needed to decode frames from the video stream.
+ * @frame_num: Frame number to seek to.
+ * @avg_frame_duration: Average frame duration, in video stream time base
+ * units.
+ * @frame_index_out: Output (approximate) frame number of the received frame.
+ *
+ * Seeks can overshoot when the reorder delay estimated by `get_reorder_delay`
+ * is too small. Each retry seeks twice as far back, down to the start of the
+ * video, so that frames are decoded forward to `frame_num` from the keyframe
+ * before it. The received frame can only be past `frame_num` if `frame_num`
+ * is before the first frame of the video.
+ *
+ * Returns the status of receiving the first frame after the last seek.
+ */
+static int32_t
+seek_at_or_before_frame_num(struct video_stream_context *vid_ctx,
+                            int32_t frame_num,
+                            int32_t avg_frame_duration,
+                            int32_t *frame_index_out)
+{
+        int32_t seek_frame_num = frame_num;
+        int32_t backoff = 0;
+        for (;;) {
+                int32_t status = seek_to_frame_num(vid_ctx,
+                                                   seek_frame_num,
+                                                   avg_frame_duration,
+                                                   frame_index_out);
+                if ((status != VID_DECODE_SUCCESS) ||
+                    (*frame_index_out <= frame_num) ||
+                    (seek_frame_num == 0))
+                        return status;
+
+                int32_t overshoot = *frame_index_out - frame_num;
+                backoff = 2*((backoff > overshoot) ? backoff : overshoot);
+                seek_frame_num = frame_num - backoff;
+                if (seek_frame_num < 0)
+                        seek_frame_num = 0;
+        }
+}
+
+/**
+ * is_keyframe_between() - Checks the container's index for a keyframe with
+ * PTS after `pts` and at or before `target_timestamp`.
+ * @vid_ctx: Context with the video stream to check.
+ * @pts: PTS of the most recently decoded frame.
+ * @target_timestamp: PTS of the next frame to decode.
+ * @reorder_delay: Reorder delay from `get_reorder_delay`, which is added to
+ * the index timestamps, in case they are DTS, to estimate keyframe PTS.
+ *
+ * If there is such a keyframe, the target frame is outside of the GOP that is
+ * currently being decoded, and seeking to it skips decoding the rest of the
+ * current GOP (and any GOPs in between). Otherwise, it is cheaper to keep
+ * decoding forward.
+ *
+ * Containers without an index never report a keyframe.
+ */
+static bool
+is_keyframe_between(struct video_stream_context *vid_ctx,
+                    int64_t pts,
+                    int64_t target_timestamp,
+                    int64_t reorder_delay)
+{
+        AVStream *video_stream =
+                vid_ctx->format_context->streams[vid_ctx->video_stream_index];
+        int32_t index = av_index_search_timestamp(video_stream,
+                                                  target_timestamp -
+                                                  reorder_delay,
+                                                  AVSEEK_FLAG_BACKWARD);
+        if (index < 0)
+                return false;
+
+        int64_t keyframe_pts =
+                video_stream->index_entries[index].timestamp + reorder_delay;
+
+        return (keyframe_pts > pts) && (keyframe_pts <= target_timestamp);
+}
+
 void
 decode_video_from_frame_nums(uint8_t *dest,
                              struct video_stream_context *vid_ctx,
@@ -533,91 +1506,33 @@ decode_video_from_frame_nums(uint8_t *dest,
                 return;
 
         AVCodecContext *codec_context = vid_ctx->codec_context;
-        struct SwsContext *sws_context = sws_getContext(codec_context->width,
-                                                        codec_context->height,
-                                                        codec_context->pix_fmt,
-                                                        codec_context->width,
-                                                        codec_context->height,
-                                                        AV_PIX_FMT_RGB24,
-                                                        SWS_BILINEAR,
-                                                        NULL,
-                                                        NULL,
-                                                        NULL);
-        assert(sws_context != NULL);
-
-        AVFrame *frame_rgb = allocate_rgb_image(codec_context);
-        assert(frame_rgb != NULL);
-
         int32_t status;
-        uint32_t copied_bytes = 0;
-        const uint32_t bytes_per_row = 3*frame_rgb->width;
-        const uint32_t bytes_per_frame = bytes_per_row*frame_rgb->height;
+        size_t copied_bytes = 0;
+        const size_t bytes_per_frame = out_frame_size(vid_ctx->out_format,
+                                                      codec_context->width,
+                                                      codec_context->height);
         int32_t current_frame_index = 0;
-        int32_t out_frame_index = 0;
         int64_t prev_pts = 0;
+        /**
+         * NOTE(brendan): Convert from frame number to video stream time base
+         * by multiplying by the _average_ time (in video_stream->time_base
+         * units) per frame.
+         */
+        int32_t avg_frame_duration = 0;
+        int64_t reorder_delay = 0;
         if (should_seek) {
-                /**
-                 * NOTE(brendan): Convert from frame number to video stream
-                 * time base by multiplying by the _average_ time (in
-                 * video_stream->time_base units) per frame.
-                 */
-                int32_t avg_frame_duration = (vid_ctx->duration /
-                                              vid_ctx->nb_frames);
-                int64_t timestamp = frame_numbers[0]*avg_frame_duration;
-                status = av_seek_frame(vid_ctx->format_context,
-                                       vid_ctx->video_stream_index,
-                                       timestamp,
-                                       AVSEEK_FLAG_BACKWARD);
-                assert(status >= 0);
-
-                /**
-                 * NOTE(brendan): Here we are handling seeking, where we need
-                 * to decode the first frame in order to get the current PTS in
-                 * the video stream.
-                 *
-                 * Most likely, the seek brought the video stream to a keyframe
-                 * before the first desired frame, in which case we need to:
-                 *
-                 * 1. Determine which frame the video stream is at, by decoding
-                 * the first frame and using its PTS and using the average
-                 * frame duration approximation again.
-                 *
-                 * 2. Possibly copy this decoded frame into the output buffer,
-                 * if by chance the frame seeked to is the first desired frame.
-                 */
-                status = receive_frame(vid_ctx);
-                if (status == VID_DECODE_EOF)
-                        goto out_free_frame_rgb_and_sws;
-                assert(status == VID_DECODE_SUCCESS);
-
-                current_frame_index = vid_ctx->frame->pts/avg_frame_duration;
-                assert(current_frame_index <= frame_numbers[0]);
-
-                /**
-                 * NOTE(brendan): Handle the chance that the seek brought the
-                 * stream exactly to the first desired frame index.
-                 */
-                if (current_frame_index == frame_numbers[0]) {
-                        copied_bytes = copy_next_frame(dest,
-                                                       vid_ctx->frame,
-                                                       frame_rgb,
-                                                       codec_context,
-                                                       sws_context,
-                                                       copied_bytes,
-                                                       bytes_per_row);
-                        ++out_frame_index;
-                }
-                ++current_frame_index;
-
-                prev_pts = vid_ctx->frame->pts;
+                avg_frame_duration = (vid_ctx->duration/vid_ctx->nb_frames);
+                reorder_delay = get_reorder_delay(vid_ctx, avg_frame_duration);
         }
 
-        for (;
+        for (int32_t out_frame_index = 0;
              out_frame_index < num_requested_frames;
              ++out_frame_index) {
                 int32_t desired_frame_num = frame_numbers[out_frame_index];
-                assert((desired_frame_num >= current_frame_index) &&
-                       (desired_frame_num >= 0));
+                assert((desired_frame_num >= 0) &&
+                       ((out_frame_index == 0) ||
+                        (desired_frame_num >
+                         frame_numbers[out_frame_index - 1])));
 
                 /* Loop frames instead of aborting if we asked for too many. */
                 if (desired_frame_num > vid_ctx->nb_frames) {
@@ -626,7 +1541,57 @@ decode_video_from_frame_nums(uint8_t *dest,
                                            out_frame_index,
                                            bytes_per_frame,
                                            num_requested_frames);
-                        goto out_free_frame_rgb_and_sws;
+                        return;
+                }
+
+                /**
+                 * NOTE(brendan): Seek to the first desired frame, and from
+                 * then on only seek if the next desired frame is past the
+                 * next keyframe. Frames inside the current GOP are reached by
+                 * decoding forward, which avoids flushing the decoder and
+                 * re-decoding a keyframe.
+                 */
+                int64_t desired_timestamp =
+                        desired_frame_num*(int64_t)avg_frame_duration;
+                if (should_seek &&
+                    ((out_frame_index == 0) ||
+                     ((desired_frame_num > current_frame_index) &&
+                      is_keyframe_between(vid_ctx,
+                                          prev_pts,
+                                          desired_timestamp,
+                                          reorder_delay)))) {
+                        /**
+                         * NOTE(brendan): The seek most likely brought the
+                         * video stream to a keyframe before the desired
+                         * frame. The frame index of the stream is determined
+                         * by decoding the first frame and using its PTS and
+                         * the average frame duration approximation again.
+                         *
+                         * If by chance the frame seeked to is the desired
+                         * frame, the loop below receives no more frames and
+                         * it is copied to the output buffer directly.
+                         *
+                         * If the seek overshoots the desired frame, it is
+                         * retried from further back, so that the desired
+                         * frame is reached by decoding forward.
+                         */
+                        status = seek_at_or_before_frame_num(
+                                vid_ctx,
+                                desired_frame_num,
+                                avg_frame_duration,
+                                &current_frame_index);
+                        if (status == VID_DECODE_EOF) {
+                                loop_to_buffer_end(dest,
+                                                   copied_bytes,
+                                                   out_frame_index,
+                                                   bytes_per_frame,
+                                                   num_requested_frames);
+                                return;
+                        }
+                        assert(status == VID_DECODE_SUCCESS);
+
+                        ++current_frame_index;
+                        prev_pts = vid_ctx->frame->pts;
                 }
 
                 while (current_frame_index <= desired_frame_num) {
@@ -637,7 +1602,7 @@ decode_video_from_frame_nums(uint8_t *dest,
                                                    out_frame_index,
                                                    bytes_per_frame,
                                                    num_requested_frames);
-                                goto out_free_frame_rgb_and_sws;
+                                return;
                         }
                         assert(status == VID_DECODE_SUCCESS);
 
@@ -654,16 +1619,119 @@ decode_video_from_frame_nums(uint8_t *dest,
                 }
 
                 copied_bytes = copy_next_frame(dest,
-                                               vid_ctx->frame,
-                                               frame_rgb,
-                                               codec_context,
-                                               sws_context,
+                                               vid_ctx,
                                                copied_bytes,
-                                               bytes_per_row);
+                                               bytes_per_frame);
+        }
+}
+
+/**
+ * append_keyframe_num() - Appends `frame_num` to the array `*keyframe_nums`,
+ * growing it as needed.
+ * @keyframe_nums: Array of keyframe numbers, allocated with av_realloc_array.
+ * On failure, the array is freed and set to NULL.
+ * @num_keyframes: Number of keyframe numbers in the array.
+ * @capacity: Number of keyframe numbers the array has room for.
+ * @frame_num: Keyframe number to append.
+ *
+ * Returns false if the array could not be grown.
+ */
+static bool
+append_keyframe_num(int32_t **keyframe_nums,
+                    int32_t *num_keyframes,
+                    int32_t *capacity,
+                    int32_t frame_num)
+{
+        if (*num_keyframes == *capacity) {
+                *capacity = (*capacity == 0) ? 64 : 2*(*capacity);
+                int32_t *resized = av_realloc_array(*keyframe_nums,
+                                                    *capacity,
+                                                    sizeof(int32_t));
+                if (resized == NULL) {
+                        av_freep(keyframe_nums);
+                        return false;
+                }
+                *keyframe_nums = resized;
+        }
+
+        (*keyframe_nums)[*num_keyframes] = frame_num;
+        ++(*num_keyframes);
+
+        return true;
+}
+
+int32_t
+read_keyframe_frame_nums(int32_t **keyframe_nums_out,
+                         struct video_stream_context *vid_ctx)
+{
+        AVPacket packet;
+        int32_t *keyframe_nums = NULL;
+        int32_t num_keyframes = 0;
+        int32_t capacity = 0;
+
+        *keyframe_nums_out = NULL;
+
+        int32_t avg_frame_duration = (vid_ctx->duration /
+                                      vid_ctx->nb_frames);
+        if (avg_frame_duration <= 0)
+                return 0;
+
+        /**
+         * NOTE(brendan): Containers with an index, e.g., MP4 and (seekable)
+         * Matroska, have their keyframes listed in the index once the header
+         * is read, which avoids reading the whole bitstream.
+         *
+         * Index timestamps can be DTS (e.g., for MP4), so the reorder delay
+         * is added to get the same PTS-based frame numbers as the packet
+         * scan below, and as decoding.
+         */
+        AVStream *video_stream =
+                vid_ctx->format_context->streams[vid_ctx->video_stream_index];
+        if (video_stream->nb_index_entries > 0) {
+                const int64_t reorder_delay =
+                        get_reorder_delay(vid_ctx, avg_frame_duration);
+                for (int32_t i = 0;
+                     i < video_stream->nb_index_entries;
+                     ++i) {
+                        const AVIndexEntry *entry =
+                                &video_stream->index_entries[i];
+                        if (!(entry->flags & AVINDEX_KEYFRAME))
+                                continue;
+
+                        if (!append_keyframe_num(&keyframe_nums,
+                                                 &num_keyframes,
+                                                 &capacity,
+                                                 (entry->timestamp +
+                                                  reorder_delay)/
+                                                 avg_frame_duration))
+                                return VID_DECODE_FFMPEG_ERR;
+                }
+
+                *keyframe_nums_out = keyframe_nums;
+
+                return num_keyframes;
+        }
+
+        av_init_packet(&packet);
+        while (av_read_frame(vid_ctx->format_context, &packet) == 0) {
+                bool is_keyframe =
+                        ((packet.stream_index == vid_ctx->video_stream_index) &&
+                         (packet.flags & AV_PKT_FLAG_KEY));
+                int64_t pts = (packet.pts != AV_NOPTS_VALUE) ?
+                              packet.pts : packet.dts;
+                av_packet_unref(&packet);
+
+                if (!is_keyframe || (pts == AV_NOPTS_VALUE))
+                        continue;
+
+                if (!append_keyframe_num(&keyframe_nums,
+                                         &num_keyframes,
+                                         &capacity,
+                                         pts/avg_frame_duration))
+                        return VID_DECODE_FFMPEG_ERR;
         }
 
-out_free_frame_rgb_and_sws:
-        av_freep(frame_rgb->data);
-        av_frame_free(&frame_rgb);
-        sws_freeContext(sws_context);
+        *keyframe_nums_out = keyframe_nums;
+
+        return num_keyframes;
 }
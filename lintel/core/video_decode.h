@@ -24,11 +24,13 @@
 extern "C" {
 #endif
 #include <libavformat/avformat.h>
+#include <libavutil/hwcontext.h>
 #include <libavutil/imgutils.h>
 #include <libswscale/swscale.h>
 #ifdef __cplusplus
 };
 #endif
+#include <stddef.h>
 #include <stdint.h>
 #include <stdbool.h>
 
@@ -38,14 +40,94 @@ extern "C" {
 
 struct buffer_data {
         const char *ptr;
-        int32_t offset_bytes;
-        int32_t total_size_bytes;
+        int64_t offset_bytes;
+        int64_t total_size_bytes;
+};
+
+/**
+ * enum out_dtype - Element type of the decoded frames in the output buffer.
+ * @OUT_DTYPE_UINT8: Raw RGB24 values.
+ * @OUT_DTYPE_FLOAT32: Normalized single precision floats.
+ * @OUT_DTYPE_FLOAT16: Normalized IEEE 754 half precision floats.
+ * @OUT_DTYPE_BFLOAT16: Normalized bfloat16 values, i.e., the upper 16 bits of
+ * the corresponding (rounded) single precision floats.
+ */
+enum out_dtype {
+        OUT_DTYPE_UINT8 = 0,
+        OUT_DTYPE_FLOAT32,
+        OUT_DTYPE_FLOAT16,
+        OUT_DTYPE_BFLOAT16,
+};
+
+/**
+ * enum out_layout - Memory layout of each decoded frame in the output buffer.
+ * @OUT_LAYOUT_NHWC: Interleaved RGB pixels, i.e., (height, width, 3).
+ * @OUT_LAYOUT_NCHW: Separate R, G and B planes, i.e., (3, height, width).
+ */
+enum out_layout {
+        OUT_LAYOUT_NHWC = 0,
+        OUT_LAYOUT_NCHW,
+};
+
+/**
+ * enum out_pix_fmt - Pixel format of the decoded frames in the output buffer.
+ * @OUT_PIX_FMT_RGB24: RGB pixels, in the output buffer's dtype and layout.
+ * @OUT_PIX_FMT_YUV420P: The uint8 Y plane, followed by the half-width and
+ * half-height U and V planes, i.e., (height*3/2, width) for even sizes.
+ * @OUT_PIX_FMT_GRAY: The uint8 luma (Y) plane only, i.e., (height, width).
+ */
+enum out_pix_fmt {
+        OUT_PIX_FMT_RGB24 = 0,
+        OUT_PIX_FMT_YUV420P,
+        OUT_PIX_FMT_GRAY,
+};
+
+struct out_format;
+
+/**
+ * typedef convert_row_fn - Converts one row of `width` RGB24 pixels from `src`
+ * to the output format, writing to `dest_rows[0]` for interleaved output, or
+ * to the R, G and B plane rows `dest_rows[0..2]` for planar output.
+ */
+typedef void (*convert_row_fn)(uint8_t *dest_rows[3],
+                               const uint8_t *src,
+                               int32_t width,
+                               const struct out_format *out_format);
+
+/**
+ * struct out_format - Format of the decoded frames in the output buffer.
+ * @pix_fmt: Pixel format of the output buffer.
+ * @dtype: Element type of the output buffer.
+ * @layout: Memory layout of each frame in the output buffer.
+ * @convert_row: Row conversion kernel for `dtype` and `layout`, selected by
+ * `set_out_format`.
+ * @lut: Per-channel (R, G, B) lookup tables from each uint8 value to the
+ * normalized output element, filled in by `set_out_format`. Unused for
+ * OUT_DTYPE_UINT8.
+ */
+struct out_format {
+        enum out_pix_fmt pix_fmt;
+        enum out_dtype dtype;
+        enum out_layout layout;
+        convert_row_fn convert_row;
+        union {
+                float f32[3][256];
+                uint16_t f16[3][256];
+        } lut;
 };
 
 /**
  * struct video_stream_context - Context needed to decode and receive frames
  * from a video stream.
  * @frame: Output frame to be received.
+ * @frame_rgb: Padded staging frame in the output pixel format, allocated on
+ * demand for frames that swscale cannot convert directly into the output
+ * buffer.
+ * @sws_context: Context used to convert received frames to the output pixel
+ * format, created on the first frame that needs converting and reused for the
+ * rest of the video.
+ * @out_format: Format to write decoded frames in, which should have the same
+ * lifetime as the video_stream_context.
  * @format_context: Format context to read from.
  * @codec_context: Context of decoder used to decode video stream packets.
  * @video_stream_index: Index of video stream that frames will be read from.
@@ -54,6 +136,9 @@ struct buffer_data {
  */
 struct video_stream_context {
         AVFrame *frame;
+        AVFrame *frame_rgb;
+        struct SwsContext *sws_context;
+        const struct out_format *out_format;
         AVCodecContext *codec_context;
         AVFormatContext *format_context;
         int32_t video_stream_index;
@@ -61,6 +146,54 @@ struct video_stream_context {
         int64_t nb_frames;
 };
 
+/**
+ * Fills in `out_format` to convert decoded frames to `pix_fmt`. For
+ * OUT_PIX_FMT_RGB24, RGB values are converted to elements of type `dtype`,
+ * laid out in memory as given by `layout`. The other pixel formats are always
+ * OUT_DTYPE_UINT8, and copied out of the decoded frame without conversion if
+ * the decoder outputs them already.
+ *
+ * For floating point types, each value is scaled to [0, 1] and then
+ * normalized per channel, i.e., (value/255 - mean[c])/std[c]. The conversion
+ * is precomputed into lookup tables, so that it is done in the same pass that
+ * copies each frame into the output buffer.
+ *
+ * @param out_format Output format to fill in.
+ * @param pix_fmt Pixel format of the output buffer.
+ * @param dtype Element type of the output buffer.
+ * @param layout Memory layout of each frame in the output buffer.
+ * @param mean Per-channel (R, G, B) means. Ignored for OUT_DTYPE_UINT8.
+ * @param std Per-channel (R, G, B) standard deviations, which must be
+ * non-zero. Ignored for OUT_DTYPE_UINT8.
+ */
+void
+set_out_format(struct out_format *out_format,
+               enum out_pix_fmt pix_fmt,
+               enum out_dtype dtype,
+               enum out_layout layout,
+               const float mean[3],
+               const float std[3]);
+
+/**
+ * @param dtype Element type of an output buffer.
+ *
+ * @return The size, in bytes, of one element of type `dtype`.
+ */
+uint32_t out_dtype_size(enum out_dtype dtype);
+
+/**
+ * @param out_format Format of an output buffer.
+ * @param width Width of the decoded frames.
+ * @param height Height of the decoded frames.
+ *
+ * @return The size, in bytes, of one `width` x `height` frame in the output
+ * buffer.
+ */
+size_t
+out_frame_size(const struct out_format *out_format,
+               uint32_t width,
+               uint32_t height);
+
 /**
  * A function for refilling the buffer from a `struct buffer_data` instance.
  *
@@ -111,14 +244,29 @@ setup_format_context(AVFormatContext **format_context_ptr,
  * Allocates a codec context for video_stream, and opens it.  We cannot call
  * avcodec_open2 on an av_stream's codec context directly.
  *
+ * If `hw_device_type` is not AV_HWDEVICE_TYPE_NONE, a hardware device of that
+ * type is created and attached to the codec context, so that frames are
+ * decoded to hardware surfaces. If the codec or the system does not support
+ * the device type, decoding falls back to software.
+ *
+ * Frame and slice threading are enabled, as supported by the codec, with
+ * `num_threads` threads. Frame threading is not used together with hardware
+ * decoding.
+ *
  * @param video_stream Video stream to open codec context for.
+ * @param hw_device_type Hardware device type to decode with.
+ * @param num_threads Number of decoding threads, or 0 to use one thread per
+ * CPU core.
  *
  * @warning If successful, codec_context must be freed with
  * avcodec_free_context, and closed with avcodec_close.
  *
  * @return Opened copy of codec_context on success, NULL on failure.
  */
-AVCodecContext *open_video_codec_ctx(AVStream *video_stream);
+AVCodecContext *
+open_video_codec_ctx(AVStream *video_stream,
+                     enum AVHWDeviceType hw_device_type,
+                     uint32_t num_threads);
 
 /**
  * Seeks the video stream corresponding to `video_stream_index` in
@@ -159,9 +307,20 @@ seek_to_closest_keypoint(float *seek_distance_out,
 int32_t
 skip_past_timestamp(struct video_stream_context *vid_ctx, int64_t timestamp);
 
+/**
+ * Seeks the video stream back to its first frame, and flushes the decoder, so
+ * that an already set up `vid_ctx` can be decoded from again as if it had just
+ * been opened.
+ *
+ * @param vid_ctx Context with the video stream to rewind.
+ *
+ * @return VID_DECODE_SUCCESS on success, VID_DECODE_FFMPEG_ERR on failure.
+ */
+int32_t rewind_video_stream(struct video_stream_context *vid_ctx);
+
 /**
  * Decodes video from the video stream corresponding to `video_stream_index`,
- * into raw RGB24 frames in `dest`.
+ * into RGB frames in `dest`, in the format given by `vid_ctx->out_format`.
  *
  * If less than `num_requested_frames` are sent from the video stream, then
  * however many frames were received are looped until `num_requested_frames`,
@@ -170,7 +329,7 @@ skip_past_timestamp(struct video_stream_context *vid_ctx, int64_t timestamp);
  *
  * TODO(brendan): Support fixing the framerate?
  *
- * @param dest Output RGB24 frame buffer.
+ * @param dest Output RGB frame buffer.
  * @param vid_ctx Context needed to decode frames from the video stream.
  * @param num_requested_frames Number of frames requested to fill into `dest`.
  */
@@ -193,6 +352,9 @@ decode_video_to_out_buffer(uint8_t *dest,
  * closest keyframe before the first desired frame index. Note that this makes
  * the assumption of a fixed FPS, and for variable framerate videos the
  * approximation of average PTS duration per frame is made to do the seek.
+ * With `should_seek` set, later desired frames that lie past the next keyframe
+ * (according to the container's index) are also seeked to, while frames
+ * within the current GOP are reached by decoding forward.
  *
  * If there are less than `num_requested_frames` to decode from the video
  * stream, then the initial frames are looped repeatedly until the end of the
@@ -205,4 +367,26 @@ decode_video_from_frame_nums(uint8_t *dest,
                              const int32_t *frame_numbers,
                              bool should_seek);
 
+/**
+ * read_keyframe_frame_nums() - Collects the (approximate) frame numbers of the
+ * keyframes in the video stream.
+ * @keyframe_nums_out: Output pointer to the array of keyframe numbers, which
+ * is allocated by this function and must be freed by the caller with av_free.
+ * @vid_ctx: Context with the video stream to scan.
+ *
+ * The keyframes are read from the container's index if it has one. Otherwise,
+ * every packet in the video stream is read, and only packet headers are
+ * inspected: no frames are decoded. Frame numbers are computed from
+ * timestamps using the same average frame duration approximation as
+ * `decode_video_from_frame_nums` uses to seek, so that a seek to a returned
+ * frame number lands on that keyframe.
+ *
+ * If the packets are read, the video stream is left at EOF.
+ *
+ * Returns the number of keyframes found, or VID_DECODE_FFMPEG_ERR on failure.
+ */
+int32_t
+read_keyframe_frame_nums(int32_t **keyframe_nums_out,
+                         struct video_stream_context *vid_ctx);
+
 #endif // _VIDEO_DECODE_H_
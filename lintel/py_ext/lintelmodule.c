@@ -17,13 +17,18 @@
 /**
  * Load video data.
  */
+#define PY_SSIZE_T_CLEAN
 #include "core/video_decode.h"
 #include <libavformat/avformat.h>
 #include <libavutil/imgutils.h>
 #include <libswscale/swscale.h>
 #include <Python.h>
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/arrayobject.h>
+#include <structmember.h>
 #include <stdbool.h>
 #include <stdlib.h>
+#include <string.h>
 #include <sys/syscall.h>
 #include <time.h>
 
@@ -36,31 +41,122 @@
 PyDoc_STRVAR(module_doc, "Module for loading video data.");
 
 /**
- * Allocates a PyByteArrayObject, and `out_size_bytes` of buffer for that
- * object.
+ * out_dtype_to_npy() - Gets the numpy type number of elements of type `dtype`.
  *
- * If the memory allocation fails, the references will be cleaned up by this
- * function. If a reference to a PyByteArrayObject object is returned, that
- * reference is owned by the caller.
+ * NOTE(brendan): numpy has no bfloat16 type, so bfloat16 frames are returned
+ * as their uint16 bit patterns, e.g., for `torch.from_numpy(frames).view(
+ * torch.bfloat16)`.
  */
-static PyByteArrayObject *
-alloc_pyarray(const uint32_t out_size_bytes)
+static int32_t
+out_dtype_to_npy(enum out_dtype dtype)
+{
+        switch (dtype) {
+        case OUT_DTYPE_FLOAT32:
+                return NPY_FLOAT32;
+        case OUT_DTYPE_FLOAT16:
+                return NPY_FLOAT16;
+        case OUT_DTYPE_BFLOAT16:
+                return NPY_UINT16;
+        case OUT_DTYPE_UINT8:
+        default:
+                return NPY_UINT8;
+        }
+}
+
+/**
+ * alloc_frames_array() - Allocates an uninitialized numpy array, of shape
+ * (num_frames, height, width, C) or (num_frames, C, height, width) depending
+ * on the layout of `out_format`, and elements of its type, that frames are
+ * decoded directly into.
+ *
+ * C is 3 for RGB24 frames and 1 for grayscale frames. YUV420P frames are
+ * (num_frames, height*3/2, width), i.e., the Y plane stacked on top of the U
+ * and V planes.
+ *
+ * If a reference to a PyArrayObject is returned, that reference is owned by
+ * the caller. Otherwise NULL is returned with a Python exception set.
+ */
+static PyArrayObject *
+alloc_frames_array(const Py_ssize_t num_frames,
+                   const uint32_t width,
+                   const uint32_t height,
+                   const struct out_format *out_format)
 {
-        PyByteArrayObject *frames = PyObject_New(PyByteArrayObject,
-                                                 &PyByteArray_Type);
+        int32_t num_dims = 4;
+        const npy_intp channels =
+                (out_format->pix_fmt == OUT_PIX_FMT_GRAY) ? 1 : 3;
+        npy_intp dims[4] = {num_frames, height, width, channels};
+        if (out_format->pix_fmt == OUT_PIX_FMT_YUV420P) {
+                num_dims = 3;
+                dims[1] = height*3/2;
+        } else if (out_format->layout == OUT_LAYOUT_NCHW) {
+                dims[1] = channels;
+                dims[2] = height;
+                dims[3] = width;
+        }
+
+        return (PyArrayObject *)PyArray_SimpleNew(
+                num_dims, dims, out_dtype_to_npy(out_format->dtype));
+}
+
+/**
+ * get_frames_buffer() - Gets the object that `num_frames` frames of size
+ * `width`x`height` will be decoded into, and a writable view of its buffer.
+ * @view: Output view of the frames buffer, which the caller must release with
+ * PyBuffer_Release.
+ * @out: Caller-provided output object, e.g., from `lintel.make_output_buffer`.
+ * If NULL or None, a new array is allocated with `alloc_frames_array`.
+ * @out_format: Format that frames will be decoded to.
+ *
+ * `out` must expose a writable, C-contiguous buffer that is large enough to
+ * hold the decoded frames, so that it can be reused across calls.
+ *
+ * Returns a new reference to the frames object (`out` or a new array), or
+ * NULL with a Python exception set.
+ */
+static PyObject *
+get_frames_buffer(Py_buffer *view,
+                  PyObject *out,
+                  const Py_ssize_t num_frames,
+                  const uint32_t width,
+                  const uint32_t height,
+                  const struct out_format *out_format)
+{
+        if ((out_format->pix_fmt == OUT_PIX_FMT_YUV420P) &&
+            (((width % 2) != 0) || ((height % 2) != 0))) {
+                PyErr_SetString(PyExc_ValueError,
+                                "pix_fmt 'yuv420p' requires an even width and "
+                                "height");
+                return NULL;
+        }
+
+        PyObject *frames = out;
+        if ((frames == NULL) || (frames == Py_None))
+                frames = (PyObject *)alloc_frames_array(num_frames,
+                                                        width,
+                                                        height,
+                                                        out_format);
+        else
+                Py_INCREF(frames);
         if (frames == NULL)
                 return NULL;
 
-        frames->ob_bytes = PyObject_Malloc(out_size_bytes);
-        if (frames->ob_bytes == NULL) {
+        if (PyObject_GetBuffer(frames,
+                               view,
+                               PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) < 0) {
                 Py_DECREF(frames);
-                return (PyByteArrayObject *)PyErr_NoMemory();
+                return NULL;
         }
 
-        Py_SIZE(frames) = out_size_bytes;
-        frames->ob_alloc = out_size_bytes;
-        frames->ob_start = frames->ob_bytes;
-        frames->ob_exports = 0;
+        const Py_ssize_t bytes_per_frame =
+                out_frame_size(out_format, width, height);
+        if (view->len < num_frames*bytes_per_frame) {
+                PyErr_SetString(PyExc_ValueError,
+                                "out is too small to hold the decoded frames");
+                PyBuffer_Release(view);
+                Py_DECREF(frames);
+                return NULL;
+        }
 
         return frames;
 }
@@ -71,6 +167,11 @@ alloc_pyarray(const uint32_t out_size_bytes)
  * @vid_ctx: Output video_stream_context to be filled in.
  * @input_buf: buffer_data structure injected into `vid_ctx`, which should have
  * the same lifetime as `vid_ctx`.
+ * @hw_device_type: Hardware device type to decode with, or
+ * AV_HWDEVICE_TYPE_NONE for software decoding.
+ * @num_threads: Number of decoding threads, 0 for one per CPU core.
+ * @out_format: Format to decode frames to, which should have the same lifetime
+ * as `vid_ctx`.
  *
  * LOADVID_ERR_STREAM_INDEX is returned if the video corresponding to
  * `input_buf`'s stream index was not found. For other errors, LOADVID_ERR is
@@ -78,7 +179,10 @@ alloc_pyarray(const uint32_t out_size_bytes)
  */
 static int32_t
 setup_vid_stream_context(struct video_stream_context *vid_ctx,
-                         struct buffer_data *input_buf)
+                         struct buffer_data *input_buf,
+                         enum AVHWDeviceType hw_device_type,
+                         uint32_t num_threads,
+                         const struct out_format *out_format)
 {
         const uint32_t buffer_size = 32*1024;
         uint8_t *avio_ctx_buffer = av_malloc(buffer_size);
@@ -124,7 +228,9 @@ setup_vid_stream_context(struct video_stream_context *vid_ctx,
 
         AVStream *video_stream =
                 vid_ctx->format_context->streams[vid_ctx->video_stream_index];
-        vid_ctx->codec_context = open_video_codec_ctx(video_stream);
+        vid_ctx->codec_context = open_video_codec_ctx(video_stream,
+                                                      hw_device_type,
+                                                      num_threads);
         if (vid_ctx->codec_context == NULL)
                 goto clean_up_format_context;
 
@@ -190,6 +296,10 @@ setup_vid_stream_context(struct video_stream_context *vid_ctx,
         if (vid_ctx->frame == NULL)
                 goto clean_up_avcodec;
 
+        vid_ctx->frame_rgb = NULL;
+        vid_ctx->sws_context = NULL;
+        vid_ctx->out_format = out_format;
+
         return LOADVID_SUCCESS;
 
 clean_up_avcodec:
@@ -208,6 +318,10 @@ clean_up_avio_ctx_buffer:
 static void
 clean_up_vid_ctx(struct video_stream_context *vid_ctx)
 {
+        sws_freeContext(vid_ctx->sws_context);
+        if (vid_ctx->frame_rgb != NULL)
+                av_freep(vid_ctx->frame_rgb->data);
+        av_frame_free(&vid_ctx->frame_rgb);
         av_frame_free(&vid_ctx->frame);
         avcodec_close(vid_ctx->codec_context);
         avcodec_free_context(&vid_ctx->codec_context);
@@ -245,47 +359,314 @@ get_vid_width_height(uint32_t *width,
         return is_size_dynamic;
 }
 
+/**
+ * parse_hwaccel() - Looks up the FFmpeg hardware device type named by the
+ * `hwaccel` argument passed from Python.
+ * @hw_device_type: Output device type, AV_HWDEVICE_TYPE_NONE if `hwaccel` is
+ * NULL (i.e., None was passed).
+ * @hwaccel: Device type name, e.g., "cuda", "vaapi" or "videotoolbox".
+ *
+ * Returns false, with a Python ValueError set, if `hwaccel` does not name a
+ * hardware device type supported by this build of FFmpeg.
+ */
+static bool
+parse_hwaccel(enum AVHWDeviceType *hw_device_type, const char *hwaccel)
+{
+        *hw_device_type = AV_HWDEVICE_TYPE_NONE;
+        if (hwaccel == NULL)
+                return true;
+
+        *hw_device_type = av_hwdevice_find_type_by_name(hwaccel);
+        if (*hw_device_type == AV_HWDEVICE_TYPE_NONE) {
+                PyErr_Format(PyExc_ValueError,
+                             "Unsupported hwaccel: %s",
+                             hwaccel);
+                return false;
+        }
+
+        return true;
+}
+
+/**
+ * parse_channel_stats() - Reads the per-channel `mean` or `std` argument
+ * passed from Python.
+ * @stats: Output (R, G, B) values.
+ * @stats_obj: None, a number used for all channels, or a sequence of three
+ * numbers.
+ * @default_value: Value of all channels if `stats_obj` is NULL or None.
+ * @name: Name of the argument, for error messages.
+ *
+ * Returns false, with a Python exception set, on failure.
+ */
+static bool
+parse_channel_stats(float stats[3],
+                    PyObject *stats_obj,
+                    float default_value,
+                    const char *name)
+{
+        if ((stats_obj == NULL) || (stats_obj == Py_None)) {
+                stats[0] = stats[1] = stats[2] = default_value;
+                return true;
+        }
+
+        if (PyNumber_Check(stats_obj)) {
+                stats[0] = PyFloat_AsDouble(stats_obj);
+                stats[1] = stats[2] = stats[0];
+                return !PyErr_Occurred();
+        }
+
+        PyObject *stats_seq = PySequence_Fast(stats_obj, name);
+        if (stats_seq == NULL)
+                return false;
+
+        bool is_valid = (PySequence_Fast_GET_SIZE(stats_seq) == 3);
+        if (!is_valid)
+                PyErr_Format(PyExc_ValueError,
+                             "%s must have one value per channel",
+                             name);
+
+        for (int32_t channel = 0;
+             is_valid && (channel < 3);
+             ++channel) {
+                PyObject *item = PySequence_Fast_GET_ITEM(stats_seq, channel);
+                stats[channel] = PyFloat_AsDouble(item);
+                is_valid = !PyErr_Occurred();
+        }
+        Py_DECREF(stats_seq);
+
+        return is_valid;
+}
+
+/**
+ * parse_out_format() - Fills in `out_format` from the `pix_fmt`, `dtype`,
+ * `layout`, `mean` and `std` arguments passed from Python.
+ * @out_format: Output format to fill in.
+ * @pix_fmt_name: One of "rgb24", "yuv420p" or "gray", or NULL for rgb24.
+ * @dtype_name: One of "uint8", "float32", "float16" or "bfloat16", or NULL
+ * (i.e., None was passed) for uint8.
+ * @layout_name: One of "NHWC" or "NCHW", or NULL for NHWC.
+ * @mean: Per-channel mean, see `parse_channel_stats`. Defaults to 0.
+ * @std: Per-channel standard deviation, see `parse_channel_stats`. Defaults to
+ * 1.
+ *
+ * Returns false, with a Python exception set, if the arguments are invalid.
+ */
+static bool
+parse_out_format(struct out_format *out_format,
+                 const char *pix_fmt_name,
+                 const char *dtype_name,
+                 const char *layout_name,
+                 PyObject *mean,
+                 PyObject *std)
+{
+        enum out_pix_fmt pix_fmt;
+        if ((pix_fmt_name == NULL) || (strcmp(pix_fmt_name, "rgb24") == 0)) {
+                pix_fmt = OUT_PIX_FMT_RGB24;
+        } else if (strcmp(pix_fmt_name, "yuv420p") == 0) {
+                pix_fmt = OUT_PIX_FMT_YUV420P;
+        } else if (strcmp(pix_fmt_name, "gray") == 0) {
+                pix_fmt = OUT_PIX_FMT_GRAY;
+        } else {
+                PyErr_Format(PyExc_ValueError,
+                             "Unsupported pix_fmt: %s",
+                             pix_fmt_name);
+                return false;
+        }
+
+        enum out_dtype dtype;
+        if ((dtype_name == NULL) || (strcmp(dtype_name, "uint8") == 0)) {
+                dtype = OUT_DTYPE_UINT8;
+        } else if (strcmp(dtype_name, "float32") == 0) {
+                dtype = OUT_DTYPE_FLOAT32;
+        } else if (strcmp(dtype_name, "float16") == 0) {
+                dtype = OUT_DTYPE_FLOAT16;
+        } else if (strcmp(dtype_name, "bfloat16") == 0) {
+                dtype = OUT_DTYPE_BFLOAT16;
+        } else {
+                PyErr_Format(PyExc_ValueError,
+                             "Unsupported dtype: %s",
+                             dtype_name);
+                return false;
+        }
+
+        enum out_layout layout;
+        if ((layout_name == NULL) || (strcmp(layout_name, "NHWC") == 0)) {
+                layout = OUT_LAYOUT_NHWC;
+        } else if (strcmp(layout_name, "NCHW") == 0) {
+                layout = OUT_LAYOUT_NCHW;
+        } else {
+                PyErr_Format(PyExc_ValueError,
+                             "Unsupported layout: %s",
+                             layout_name);
+                return false;
+        }
+
+        if ((pix_fmt != OUT_PIX_FMT_RGB24) && (dtype != OUT_DTYPE_UINT8)) {
+                PyErr_Format(PyExc_ValueError,
+                             "pix_fmt '%s' requires dtype uint8",
+                             pix_fmt_name);
+                return false;
+        }
+
+        if ((pix_fmt == OUT_PIX_FMT_YUV420P) && (layout != OUT_LAYOUT_NHWC)) {
+                PyErr_SetString(PyExc_ValueError,
+                                "pix_fmt 'yuv420p' requires layout NHWC");
+                return false;
+        }
+
+        bool is_normalized = ((mean != NULL) && (mean != Py_None)) ||
+                             ((std != NULL) && (std != Py_None));
+        if ((dtype == OUT_DTYPE_UINT8) && is_normalized) {
+                PyErr_SetString(PyExc_ValueError,
+                                "mean and std require a floating point dtype");
+                return false;
+        }
+
+        float mean_values[3];
+        float std_values[3];
+        if (!parse_channel_stats(mean_values, mean, 0.0f, "mean") ||
+            !parse_channel_stats(std_values, std, 1.0f, "std"))
+                return false;
+
+        if ((std_values[0] == 0.0f) ||
+            (std_values[1] == 0.0f) ||
+            (std_values[2] == 0.0f)) {
+                PyErr_SetString(PyExc_ValueError, "std must be non-zero");
+                return false;
+        }
+
+        set_out_format(out_format,
+                       pix_fmt,
+                       dtype,
+                       layout,
+                       mean_values,
+                       std_values);
+
+        return true;
+}
+
+/**
+ * frame_nums_to_buf() - Copies the frame indices in the Python sequence
+ * `frame_nums` into a newly allocated C array.
+ * @frame_nums: Python sequence of integer frame indices.
+ * @num_frames: Length of `frame_nums`.
+ *
+ * Returns NULL, with a Python exception set, on failure. Otherwise, the
+ * returned buffer is owned by the caller and must be freed with
+ * PyMem_RawFree.
+ */
+static int32_t *
+frame_nums_to_buf(PyObject *frame_nums, const Py_ssize_t num_frames)
+{
+        int32_t *frame_nums_buf = PyMem_RawMalloc(num_frames*sizeof(int32_t));
+        if (frame_nums_buf == NULL)
+                return (int32_t *)PyErr_NoMemory();
+
+        for (int32_t i = 0;
+             i < num_frames;
+             ++i) {
+                PyObject *item = PySequence_GetItem(frame_nums, i);
+                if (item == NULL)
+                        goto clean_up;
+
+                frame_nums_buf[i] = PyLong_AsLong(item);
+                Py_DECREF(item);
+                if (PyErr_Occurred())
+                        goto clean_up;
+        }
+
+        return frame_nums_buf;
+
+clean_up:
+        PyMem_RawFree(frame_nums_buf);
+
+        return NULL;
+}
+
 static PyObject *
 loadvid_frame_nums(PyObject *UNUSED(dummy), PyObject *args, PyObject *kw)
 {
         PyObject *result = NULL;
-        const char *video_bytes = NULL;
-        Py_ssize_t in_size_bytes = 0;
+        Py_buffer encoded_video;
         PyObject *frame_nums = NULL;
         uint32_t width = 0;
         uint32_t height = 0;
         /* NOTE(brendan): should_seek must be int (not bool) because Python. */
         int32_t should_seek = false;
+        const char *hwaccel = NULL;
+        enum AVHWDeviceType hw_device_type;
+        PyObject *out = NULL;
+        uint32_t num_threads = 0;
+        const char *pix_fmt = NULL;
+        const char *dtype = NULL;
+        const char *layout = NULL;
+        PyObject *mean = NULL;
+        PyObject *std = NULL;
+        struct out_format out_format;
         static char *kwlist[] = {"encoded_video",
                                  "frame_nums",
                                  "width",
                                  "height",
                                  "should_seek",
+                                 "hwaccel",
+                                 "out",
+                                 "num_threads",
+                                 "pix_fmt",
+                                 "dtype",
+                                 "layout",
+                                 "mean",
+                                 "std",
                                  0};
 
         if (!PyArg_ParseTupleAndKeywords(args,
                                          kw,
-                                         "y#|$OIIp:loadvid_frame_nums",
+                                         "y*|$OIIpzOIzzzOO:loadvid_frame_nums",
                                          kwlist,
-                                         &video_bytes,
-                                         &in_size_bytes,
+                                         &encoded_video,
                                          &frame_nums,
                                          &width,
                                          &height,
-                                         &should_seek))
+                                         &should_seek,
+                                         &hwaccel,
+                                         &out,
+                                         &num_threads,
+                                         &pix_fmt,
+                                         &dtype,
+                                         &layout,
+                                         &mean,
+                                         &std))
                 return NULL;
 
+        if (!parse_hwaccel(&hw_device_type, hwaccel))
+                goto release_encoded_video;
+
+        if (!parse_out_format(&out_format,
+                              pix_fmt,
+                              dtype,
+                              layout,
+                              mean,
+                              std))
+                goto release_encoded_video;
+
         if (!PySequence_Check(frame_nums)) {
                 PyErr_SetString(PyExc_TypeError,
                                 "frame_nums needs to be a sequence");
-                return NULL;
+                goto release_encoded_video;
         }
 
         struct video_stream_context vid_ctx;
-        struct buffer_data input_buf = {.ptr = video_bytes,
+        struct buffer_data input_buf = {.ptr = encoded_video.buf,
                                         .offset_bytes = 0,
-                                        .total_size_bytes = in_size_bytes};
-        int32_t status = setup_vid_stream_context(&vid_ctx, &input_buf);
+                                        .total_size_bytes = encoded_video.len};
+        int32_t status;
+
+        Py_BEGIN_ALLOW_THREADS
+        status = setup_vid_stream_context(&vid_ctx,
+                                          &input_buf,
+                                          hw_device_type,
+                                          num_threads,
+                                          &out_format);
+        Py_END_ALLOW_THREADS
 
         bool is_size_dynamic = get_vid_width_height(&width,
                                                     &height,
@@ -300,58 +681,61 @@ loadvid_frame_nums(PyObject *UNUSED(dummy), PyObject *args, PyObject *kw)
          * possibility that videos in the dataset have no video stream.
          */
         const Py_ssize_t num_frames = PySequence_Size(frame_nums);
-        PyByteArrayObject *frames = alloc_pyarray(num_frames*width*height*3);
-        if (PyErr_Occurred() || (frames == NULL))
-                return (PyObject *)frames;
-
+        Py_buffer frames_view;
+        PyObject *frames = get_frames_buffer(&frames_view,
+                                             out,
+                                             num_frames,
+                                             width,
+                                             height,
+                                             &out_format);
+        if (frames == NULL) {
+                if (status == LOADVID_SUCCESS)
+                        clean_up_vid_ctx(&vid_ctx);
+                goto release_encoded_video;
+        }
 
         if (status != LOADVID_SUCCESS) {
+                PyBuffer_Release(&frames_view);
                 if (status == LOADVID_ERR_STREAM_INDEX)
-                        return (PyObject *)frames;
+                        result = frames;
+                else
+                        Py_DECREF(frames);
 
-                return NULL;
+                goto release_encoded_video;
         }
 
-        int32_t *frame_nums_buf = PyMem_RawMalloc(num_frames*sizeof(int32_t));
+        int32_t *frame_nums_buf = frame_nums_to_buf(frame_nums, num_frames);
         if (frame_nums_buf == NULL)
-                return PyErr_NoMemory();
-
-        for (int32_t i = 0;
-             i < num_frames;
-             ++i) {
-                PyObject *item = PySequence_GetItem(frame_nums, i);
-                if (item == NULL)
-                        goto clean_up;
-
-                frame_nums_buf[i] = PyLong_AsLong(item);
-                Py_DECREF(item);
-                if (PyErr_Occurred())
-                        goto clean_up;
-        }
+                goto clean_up;
 
-        result = (PyObject *)frames;
+        result = frames;
 
-        decode_video_from_frame_nums((uint8_t *)(frames->ob_bytes),
+        Py_BEGIN_ALLOW_THREADS
+        decode_video_from_frame_nums((uint8_t *)frames_view.buf,
                                      &vid_ctx,
                                      num_frames,
                                      frame_nums_buf,
                                      should_seek);
+        Py_END_ALLOW_THREADS
 
         PyMem_RawFree(frame_nums_buf);
 
 clean_up:
         clean_up_vid_ctx(&vid_ctx);
+        PyBuffer_Release(&frames_view);
 
-        if (result != (PyObject *)frames) {
+        if (result != frames) {
                 Py_CLEAR(frames);
-                return result;
+                goto release_encoded_video;
         }
 
-        if (!is_size_dynamic)
-                return (PyObject *)frames;
+        if (is_size_dynamic) {
+                result = Py_BuildValue("Oii", frames, width, height);
+                Py_DECREF(frames);
+        }
 
-        result = Py_BuildValue("Oii", frames, width, height);
-        Py_DECREF(frames);
+release_encoded_video:
+        PyBuffer_Release(&encoded_video);
 
         return result;
 }
@@ -360,47 +744,104 @@ static PyObject *
 loadvid(PyObject *UNUSED(dummy), PyObject *args, PyObject *kw)
 {
         PyObject *result = NULL;
-        const char *video_bytes = NULL;
-        Py_ssize_t in_size_bytes = 0;
-        bool should_random_seek = true;
+        Py_buffer encoded_video;
+        /**
+         * NOTE(brendan): should_random_seek must be int (not bool) because
+         * Python.
+         */
+        int32_t should_random_seek = true;
         uint32_t width = 0;
         uint32_t height = 0;
         uint32_t num_frames = 32;
         float seek_distance = 0.0f;
+        const char *hwaccel = NULL;
+        enum AVHWDeviceType hw_device_type;
+        PyObject *out = NULL;
+        uint32_t num_threads = 0;
+        const char *pix_fmt = NULL;
+        const char *dtype = NULL;
+        const char *layout = NULL;
+        PyObject *mean = NULL;
+        PyObject *std = NULL;
+        struct out_format out_format;
         static char *kwlist[] = {"encoded_video",
                                  "should_random_seek",
                                  "width",
                                  "height",
                                  "num_frames",
+                                 "hwaccel",
+                                 "out",
+                                 "num_threads",
+                                 "pix_fmt",
+                                 "dtype",
+                                 "layout",
+                                 "mean",
+                                 "std",
                                  0};
 
         if (!PyArg_ParseTupleAndKeywords(args,
                                          kw,
-                                         "y#|$pIII:loadvid",
+                                         "y*|$pIIIzOIzzzOO:loadvid",
                                          kwlist,
-                                         &video_bytes,
-                                         &in_size_bytes,
+                                         &encoded_video,
                                          &should_random_seek,
                                          &width,
                                          &height,
-                                         &num_frames))
+                                         &num_frames,
+                                         &hwaccel,
+                                         &out,
+                                         &num_threads,
+                                         &pix_fmt,
+                                         &dtype,
+                                         &layout,
+                                         &mean,
+                                         &std))
                 return NULL;
 
+        if (!parse_hwaccel(&hw_device_type, hwaccel))
+                goto release_encoded_video;
+
+        if (!parse_out_format(&out_format,
+                              pix_fmt,
+                              dtype,
+                              layout,
+                              mean,
+                              std))
+                goto release_encoded_video;
+
         struct video_stream_context vid_ctx;
-        struct buffer_data input_buf = {.ptr = video_bytes,
+        struct buffer_data input_buf = {.ptr = encoded_video.buf,
                                         .offset_bytes = 0,
-                                        .total_size_bytes = in_size_bytes};
-        int32_t status = setup_vid_stream_context(&vid_ctx, &input_buf);
+                                        .total_size_bytes = encoded_video.len};
+        int32_t status;
+
+        Py_BEGIN_ALLOW_THREADS
+        status = setup_vid_stream_context(&vid_ctx,
+                                          &input_buf,
+                                          hw_device_type,
+                                          num_threads,
+                                          &out_format);
+        Py_END_ALLOW_THREADS
 
         bool is_size_dynamic = get_vid_width_height(&width,
                                                     &height,
                                                     vid_ctx.codec_context);
 
-        PyByteArrayObject *frames = alloc_pyarray(num_frames*width*height*3);
-        if (PyErr_Occurred() || (frames == NULL))
-                return (PyObject *)frames;
+        Py_buffer frames_view;
+        PyObject *frames = get_frames_buffer(&frames_view,
+                                             out,
+                                             num_frames,
+                                             width,
+                                             height,
+                                             &out_format);
+        if (frames == NULL) {
+                if (status == LOADVID_SUCCESS)
+                        clean_up_vid_ctx(&vid_ctx);
+                goto release_encoded_video;
+        }
 
         if (status != LOADVID_SUCCESS) {
+                PyBuffer_Release(&frames_view);
                 /**
                  * NOTE(brendan): In case there was a stream index error,
                  * return a garbage buffer.
@@ -408,14 +849,10 @@ loadvid(PyObject *UNUSED(dummy), PyObject *args, PyObject *kw)
                 if (status == LOADVID_ERR_STREAM_INDEX)
                           goto return_frames;
 
-                return NULL;
+                Py_DECREF(frames);
+                goto release_encoded_video;
         }
 
-        int64_t timestamp = seek_to_closest_keypoint(&seek_distance,
-                                                     &vid_ctx,
-                                                     should_random_seek,
-                                                     num_frames);
-
         /*
          * NOTE(brendan): after this point, the only possible errors are due to
          * not having enough frames in the video stream past the initial seek
@@ -426,23 +863,21 @@ loadvid(PyObject *UNUSED(dummy), PyObject *args, PyObject *kw)
          * than returning an error, if there weren't any frames to decode in
          * the first place.
          */
-        result = (PyObject *)frames;
+        Py_BEGIN_ALLOW_THREADS
+        int64_t timestamp = seek_to_closest_keypoint(&seek_distance,
+                                                     &vid_ctx,
+                                                     should_random_seek,
+                                                     num_frames);
 
         status = skip_past_timestamp(&vid_ctx, timestamp);
-        if (status != VID_DECODE_SUCCESS)
-                goto clean_up_av_frame;
+        if (status == VID_DECODE_SUCCESS)
+                decode_video_to_out_buffer((uint8_t *)frames_view.buf,
+                                           &vid_ctx,
+                                           num_frames);
+        Py_END_ALLOW_THREADS
 
-        decode_video_to_out_buffer((uint8_t *)(frames->ob_bytes),
-                                   &vid_ctx,
-                                   num_frames);
-
-clean_up_av_frame:
         clean_up_vid_ctx(&vid_ctx);
-
-        if (result != (PyObject *)frames) {
-                Py_CLEAR(frames);
-                return result;
-        }
+        PyBuffer_Release(&frames_view);
 
 return_frames:
         if (!is_size_dynamic)
@@ -455,27 +890,666 @@ return_frames:
                                        seek_distance);
         Py_DECREF(frames);
 
+release_encoded_video:
+        PyBuffer_Release(&encoded_video);
+
+        return result;
+}
+
+static PyObject *
+loadvid_frame_nums_into(PyObject *UNUSED(dummy), PyObject *args, PyObject *kw)
+{
+        Py_buffer encoded_video;
+        Py_buffer out;
+        PyObject *frame_nums = NULL;
+        Py_ssize_t offset = 0;
+        uint32_t width = 0;
+        uint32_t height = 0;
+        const char *hwaccel = NULL;
+        enum AVHWDeviceType hw_device_type;
+        uint32_t num_threads = 0;
+        const char *pix_fmt = NULL;
+        const char *dtype = NULL;
+        const char *layout = NULL;
+        PyObject *mean = NULL;
+        PyObject *std = NULL;
+        struct out_format out_format;
+        static char *kwlist[] = {"encoded_video",
+                                 "out",
+                                 "frame_nums",
+                                 "offset",
+                                 "width",
+                                 "height",
+                                 "hwaccel",
+                                 "num_threads",
+                                 "pix_fmt",
+                                 "dtype",
+                                 "layout",
+                                 "mean",
+                                 "std",
+                                 0};
+
+        if (!PyArg_ParseTupleAndKeywords(args,
+                                         kw,
+                                         "y*w*O|$nIIzIzzzOO:loadvid_frame_nums_into",
+                                         kwlist,
+                                         &encoded_video,
+                                         &out,
+                                         &frame_nums,
+                                         &offset,
+                                         &width,
+                                         &height,
+                                         &hwaccel,
+                                         &num_threads,
+                                         &pix_fmt,
+                                         &dtype,
+                                         &layout,
+                                         &mean,
+                                         &std))
+                return NULL;
+
+        PyObject *result = NULL;
+        if (!parse_hwaccel(&hw_device_type, hwaccel))
+                goto release_out;
+        if (!parse_out_format(&out_format,
+                              pix_fmt,
+                              dtype,
+                              layout,
+                              mean,
+                              std))
+                goto release_out;
+        if (!PySequence_Check(frame_nums)) {
+                PyErr_SetString(PyExc_TypeError,
+                                "frame_nums needs to be a sequence");
+                goto release_out;
+        }
+
+        if ((width == 0) || (height == 0)) {
+                PyErr_SetString(PyExc_ValueError,
+                                "width and height must be passed");
+                goto release_out;
+        }
+
+        const Py_ssize_t num_frames = PySequence_Size(frame_nums);
+        const Py_ssize_t bytes_per_frame =
+                out_frame_size(&out_format, width, height);
+        if ((offset < 0) ||
+            ((offset + num_frames)*bytes_per_frame > out.len)) {
+                PyErr_SetString(PyExc_ValueError,
+                                "out is too small to hold the decoded frames");
+                goto release_out;
+        }
+
+        int32_t *frame_nums_buf = frame_nums_to_buf(frame_nums, num_frames);
+        if (frame_nums_buf == NULL)
+                goto release_out;
+
+        uint8_t *dest = (uint8_t *)out.buf + offset*bytes_per_frame;
+        struct video_stream_context vid_ctx;
+        struct buffer_data input_buf = {.ptr = encoded_video.buf,
+                                        .offset_bytes = 0,
+                                        .total_size_bytes = encoded_video.len};
+        int32_t status;
+
+        /**
+         * NOTE(brendan): No Python objects are touched while decoding, so
+         * release the GIL to let shards of the same video decode in parallel
+         * from separate threads.
+         */
+        Py_BEGIN_ALLOW_THREADS
+        status = setup_vid_stream_context(&vid_ctx,
+                                          &input_buf,
+                                          hw_device_type,
+                                          num_threads,
+                                          &out_format);
+        if (status == LOADVID_SUCCESS) {
+                get_vid_width_height(&width, &height, vid_ctx.codec_context);
+
+                decode_video_from_frame_nums(dest,
+                                             &vid_ctx,
+                                             num_frames,
+                                             frame_nums_buf,
+                                             true);
+
+                clean_up_vid_ctx(&vid_ctx);
+        }
+        Py_END_ALLOW_THREADS
+
+        PyMem_RawFree(frame_nums_buf);
+
+        /**
+         * NOTE(brendan): As in `loadvid_frame_nums`, a missing video stream
+         * leaves garbage in the output buffer rather than being an error.
+         */
+        if ((status != LOADVID_SUCCESS) &&
+            (status != LOADVID_ERR_STREAM_INDEX)) {
+                PyErr_SetString(PyExc_RuntimeError,
+                                "Failed to open the video stream");
+                goto release_out;
+        }
+
+        result = Py_None;
+        Py_INCREF(result);
+
+release_out:
+        PyBuffer_Release(&out);
+        PyBuffer_Release(&encoded_video);
+
+        return result;
+}
+
+static PyObject *
+get_keyframe_frame_nums(PyObject *UNUSED(dummy), PyObject *args, PyObject *kw)
+{
+        Py_buffer encoded_video;
+        static char *kwlist[] = {"encoded_video", 0};
+
+        if (!PyArg_ParseTupleAndKeywords(args,
+                                         kw,
+                                         "y*:get_keyframe_frame_nums",
+                                         kwlist,
+                                         &encoded_video))
+                return NULL;
+
+        struct video_stream_context vid_ctx;
+        struct buffer_data input_buf = {.ptr = encoded_video.buf,
+                                        .offset_bytes = 0,
+                                        .total_size_bytes = encoded_video.len};
+        int32_t *keyframe_nums = NULL;
+        int32_t num_keyframes = 0;
+        uint32_t width = 0;
+        uint32_t height = 0;
+        int64_t nb_frames = 0;
+        int32_t status;
+
+        Py_BEGIN_ALLOW_THREADS
+        status = setup_vid_stream_context(&vid_ctx,
+                                          &input_buf,
+                                          AV_HWDEVICE_TYPE_NONE,
+                                          1,
+                                          NULL);
+        if (status == LOADVID_SUCCESS) {
+                get_vid_width_height(&width, &height, vid_ctx.codec_context);
+                nb_frames = vid_ctx.nb_frames;
+
+                num_keyframes = read_keyframe_frame_nums(&keyframe_nums,
+                                                         &vid_ctx);
+
+                clean_up_vid_ctx(&vid_ctx);
+        }
+        Py_END_ALLOW_THREADS
+
+        PyBuffer_Release(&encoded_video);
+
+        /**
+         * NOTE(brendan): Videos that cannot be opened or scanned report no
+         * keyframes, so that callers fall back to serial decoding (which
+         * handles those errors).
+         */
+        if (num_keyframes < 0)
+                num_keyframes = 0;
+
+        PyObject *keyframe_list = PyList_New(num_keyframes);
+        if (keyframe_list == NULL)
+                goto clean_up;
+
+        for (int32_t i = 0;
+             i < num_keyframes;
+             ++i) {
+                PyObject *item = PyLong_FromLong(keyframe_nums[i]);
+                if (item == NULL) {
+                        Py_CLEAR(keyframe_list);
+                        goto clean_up;
+                }
+
+                PyList_SET_ITEM(keyframe_list, i, item);
+        }
+
+clean_up:
+        av_free(keyframe_nums);
+
+        if (keyframe_list == NULL)
+                return NULL;
+
+        return Py_BuildValue("NIIL",
+                             keyframe_list,
+                             width,
+                             height,
+                             (long long)nb_frames);
+}
+
+/**
+ * struct video_reader - Python VideoReader object, which keeps the FFmpeg
+ * contexts of one video open, so that frames can be decoded from it
+ * repeatedly without re-parsing the container and re-opening the codec.
+ * @encoded_video: View of the bytes-like object that frames are decoded from,
+ * e.g., bytes or a memoryview of an mmap of the video file.
+ * @input_buf: buffer_data reading from `encoded_video`.
+ * @vid_ctx: Context of the open video stream, valid iff `is_open`.
+ * @out_format: Format that frames are decoded to.
+ * @width: Width of the video.
+ * @height: Height of the video.
+ * @is_open: Whether `vid_ctx` has been set up.
+ * @is_busy: Whether `vid_ctx` is in use by a thread that released the GIL.
+ */
+struct video_reader {
+        PyObject_HEAD
+        Py_buffer encoded_video;
+        struct buffer_data input_buf;
+        struct video_stream_context vid_ctx;
+        struct out_format out_format;
+        uint32_t width;
+        uint32_t height;
+        bool is_open;
+        bool is_busy;
+};
+
+/**
+ * video_reader_acquire() - Marks `self` as busy, before its `vid_ctx` is used
+ * with the GIL released.
+ *
+ * Returns false, with a Python exception set, if `self` is not open or is
+ * already in use by another thread.
+ */
+static bool
+video_reader_acquire(struct video_reader *self)
+{
+        if (!self->is_open) {
+                PyErr_SetString(PyExc_ValueError, "VideoReader is not open");
+                return false;
+        }
+
+        if (self->is_busy) {
+                PyErr_SetString(PyExc_RuntimeError,
+                                "VideoReader is in use by another thread");
+                return false;
+        }
+
+        self->is_busy = true;
+
+        return true;
+}
+
+static void
+video_reader_close(struct video_reader *self)
+{
+        if (self->is_open) {
+                clean_up_vid_ctx(&self->vid_ctx);
+                self->is_open = false;
+        }
+
+        /**
+         * NOTE(brendan): PyBuffer_Release does nothing if the view was already
+         * released, or never acquired (i.e., the object was zeroed by
+         * tp_alloc).
+         */
+        PyBuffer_Release(&self->encoded_video);
+}
+
+static void
+video_reader_dealloc(struct video_reader *self)
+{
+        video_reader_close(self);
+        Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static int
+video_reader_init(struct video_reader *self, PyObject *args, PyObject *kw)
+{
+        Py_buffer encoded_video;
+        const char *hwaccel = NULL;
+        enum AVHWDeviceType hw_device_type;
+        uint32_t num_threads = 0;
+        const char *pix_fmt = NULL;
+        const char *dtype = NULL;
+        const char *layout = NULL;
+        PyObject *mean = NULL;
+        PyObject *std = NULL;
+        static char *kwlist[] = {"encoded_video",
+                                 "hwaccel",
+                                 "num_threads",
+                                 "pix_fmt",
+                                 "dtype",
+                                 "layout",
+                                 "mean",
+                                 "std",
+                                 0};
+
+        if (!PyArg_ParseTupleAndKeywords(args,
+                                         kw,
+                                         "y*|$zIzzzOO:VideoReader",
+                                         kwlist,
+                                         &encoded_video,
+                                         &hwaccel,
+                                         &num_threads,
+                                         &pix_fmt,
+                                         &dtype,
+                                         &layout,
+                                         &mean,
+                                         &std))
+                return -1;
+
+        if (self->is_busy) {
+                PyErr_SetString(PyExc_RuntimeError,
+                                "VideoReader is in use by another thread");
+                PyBuffer_Release(&encoded_video);
+                return -1;
+        }
+
+        if (!parse_hwaccel(&hw_device_type, hwaccel) ||
+            !parse_out_format(&self->out_format,
+                              pix_fmt,
+                              dtype,
+                              layout,
+                              mean,
+                              std)) {
+                PyBuffer_Release(&encoded_video);
+                return -1;
+        }
+
+        video_reader_close(self);
+
+        self->encoded_video = encoded_video;
+        self->input_buf.ptr = encoded_video.buf;
+        self->input_buf.offset_bytes = 0;
+        self->input_buf.total_size_bytes = encoded_video.len;
+
+        int32_t status;
+        self->is_busy = true;
+        Py_BEGIN_ALLOW_THREADS
+        status = setup_vid_stream_context(&self->vid_ctx,
+                                          &self->input_buf,
+                                          hw_device_type,
+                                          num_threads,
+                                          &self->out_format);
+        Py_END_ALLOW_THREADS
+        self->is_busy = false;
+
+        if (status == LOADVID_ERR_STREAM_INDEX) {
+                PyErr_SetString(PyExc_ValueError, "No video stream found");
+                return -1;
+        } else if (status != LOADVID_SUCCESS) {
+                PyErr_SetString(PyExc_RuntimeError,
+                                "Failed to open the video stream");
+                return -1;
+        }
+
+        self->is_open = true;
+        self->width = self->vid_ctx.codec_context->width;
+        self->height = self->vid_ctx.codec_context->height;
+
+        return 0;
+}
+
+static PyObject *
+video_reader_load(struct video_reader *self, PyObject *args, PyObject *kw)
+{
+        PyObject *frame_nums = NULL;
+        /* NOTE(brendan): should_seek must be int (not bool) because Python. */
+        int32_t should_seek = false;
+        PyObject *out = NULL;
+        PyObject *frames = NULL;
+        Py_buffer frames_view;
+        int32_t status = VID_DECODE_SUCCESS;
+        static char *kwlist[] = {"frame_nums", "should_seek", "out", 0};
+
+        if (!PyArg_ParseTupleAndKeywords(args,
+                                         kw,
+                                         "O|$pO:load",
+                                         kwlist,
+                                         &frame_nums,
+                                         &should_seek,
+                                         &out))
+                return NULL;
+
+        if (!PySequence_Check(frame_nums)) {
+                PyErr_SetString(PyExc_TypeError,
+                                "frame_nums needs to be a sequence");
+                return NULL;
+        }
+
+        const Py_ssize_t num_frames = PySequence_Size(frame_nums);
+        int32_t *frame_nums_buf = frame_nums_to_buf(frame_nums, num_frames);
+        if (frame_nums_buf == NULL)
+                return NULL;
+
+        frames = get_frames_buffer(&frames_view,
+                                   out,
+                                   num_frames,
+                                   self->width,
+                                   self->height,
+                                   &self->out_format);
+        if (frames == NULL)
+                goto clean_up;
+
+        if (!video_reader_acquire(self)) {
+                PyBuffer_Release(&frames_view);
+                Py_CLEAR(frames);
+                goto clean_up;
+        }
+
+        Py_BEGIN_ALLOW_THREADS
+        /**
+         * NOTE(brendan): With should_seek, decode_video_from_frame_nums seeks
+         * to the first frame by itself, so only frame-accurate decoding has to
+         * start over from the first frame of the video.
+         */
+        if (!should_seek)
+                status = rewind_video_stream(&self->vid_ctx);
+        if (status == VID_DECODE_SUCCESS)
+                decode_video_from_frame_nums((uint8_t *)frames_view.buf,
+                                             &self->vid_ctx,
+                                             num_frames,
+                                             frame_nums_buf,
+                                             should_seek);
+        Py_END_ALLOW_THREADS
+        self->is_busy = false;
+
+        PyBuffer_Release(&frames_view);
+
+        if (status != VID_DECODE_SUCCESS) {
+                PyErr_SetString(PyExc_RuntimeError,
+                                "Failed to rewind the video stream");
+                Py_CLEAR(frames);
+        }
+
+clean_up:
+        PyMem_RawFree(frame_nums_buf);
+
+        return frames;
+}
+
+static PyObject *
+video_reader_load_clip(struct video_reader *self, PyObject *args, PyObject *kw)
+{
+        uint32_t num_frames = 32;
+        int32_t should_random_seek = true;
+        PyObject *out = NULL;
+        float seek_distance = 0.0f;
+        static char *kwlist[] = {"num_frames",
+                                 "should_random_seek",
+                                 "out",
+                                 0};
+
+        if (!PyArg_ParseTupleAndKeywords(args,
+                                         kw,
+                                         "|$IpO:load_clip",
+                                         kwlist,
+                                         &num_frames,
+                                         &should_random_seek,
+                                         &out))
+                return NULL;
+
+        Py_buffer frames_view;
+        PyObject *frames = get_frames_buffer(&frames_view,
+                                             out,
+                                             num_frames,
+                                             self->width,
+                                             self->height,
+                                             &self->out_format);
+        if (frames == NULL)
+                return NULL;
+
+        if (!video_reader_acquire(self)) {
+                PyBuffer_Release(&frames_view);
+                Py_DECREF(frames);
+                return NULL;
+        }
+
+        int32_t status;
+        Py_BEGIN_ALLOW_THREADS
+        status = rewind_video_stream(&self->vid_ctx);
+        if (status == VID_DECODE_SUCCESS) {
+                int64_t timestamp = seek_to_closest_keypoint(&seek_distance,
+                                                             &self->vid_ctx,
+                                                             should_random_seek,
+                                                             num_frames);
+
+                /**
+                 * NOTE(brendan): As in `loadvid`, running out of frames
+                 * leaves garbage in the output buffer rather than being an
+                 * error.
+                 */
+                if (skip_past_timestamp(&self->vid_ctx,
+                                        timestamp) == VID_DECODE_SUCCESS)
+                        decode_video_to_out_buffer((uint8_t *)frames_view.buf,
+                                                   &self->vid_ctx,
+                                                   num_frames);
+        }
+        Py_END_ALLOW_THREADS
+        self->is_busy = false;
+
+        PyBuffer_Release(&frames_view);
+
+        if (status != VID_DECODE_SUCCESS) {
+                PyErr_SetString(PyExc_RuntimeError,
+                                "Failed to rewind the video stream");
+                Py_DECREF(frames);
+                return NULL;
+        }
+
+        PyObject *result = Py_BuildValue("Of", frames, seek_distance);
+        Py_DECREF(frames);
+
         return result;
 }
 
+static PyMethodDef video_reader_methods[] = {
+        {"load",
+         (PyCFunction)video_reader_load,
+         METH_VARARGS | METH_KEYWORDS,
+         PyDoc_STR("load(frame_nums, should_seek, out) -> decoded video ndarray\n"
+                   "Decodes the frames numbered by frame_nums, as loadvid_frame_nums does.")},
+        {"load_clip",
+         (PyCFunction)video_reader_load_clip,
+         METH_VARARGS | METH_KEYWORDS,
+         PyDoc_STR("load_clip(num_frames, should_random_seek, out) -> "
+                   "tuple(decoded video ndarray, seek_distance)\n"
+                   "Decodes num_frames consecutive frames, as loadvid does.")},
+        {NULL, NULL, 0, NULL}
+};
+
+static PyMemberDef video_reader_members[] = {
+        {"width",
+         T_UINT,
+         offsetof(struct video_reader, width),
+         READONLY,
+         PyDoc_STR("Width of the video.")},
+        {"height",
+         T_UINT,
+         offsetof(struct video_reader, height),
+         READONLY,
+         PyDoc_STR("Height of the video.")},
+        {NULL, 0, 0, 0, NULL}
+};
+
+static PyTypeObject video_reader_type = {
+        PyVarObject_HEAD_INIT(NULL, 0)
+        .tp_name = "_lintel.VideoReader",
+        .tp_basicsize = sizeof(struct video_reader),
+        .tp_dealloc = (destructor)video_reader_dealloc,
+        .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,
+        .tp_doc = PyDoc_STR("VideoReader(encoded_video, hwaccel, num_threads, pix_fmt, dtype, layout, mean, std)\n"
+                            "Opens encoded_video once, and keeps its demuxer, decoder and pixel format\n"
+                            "conversion contexts open, so that frames can be decoded from it repeatedly\n"
+                            "with load and load_clip. The keyword arguments are as for loadvid."),
+        .tp_methods = video_reader_methods,
+        .tp_members = video_reader_members,
+        .tp_init = (initproc)video_reader_init,
+        .tp_new = PyType_GenericNew,
+};
+
 static PyMethodDef lintel_methods[] = {
         {"loadvid",
          (PyCFunction)loadvid,
          METH_VARARGS | METH_KEYWORDS,
-         PyDoc_STR("loadvid(encoded_video, should_random_seek, width, height, num_frames) -> "
-                   "tuple(decoded video ByteArray object, seek_distance) or\n"
-                   "tuple(decoded video ByteArray object, width, height, seek_distance)\n"
-                   "if width and height are not passed as arguments.")},
+         PyDoc_STR("loadvid(encoded_video, should_random_seek, width, height, num_frames, hwaccel, out, num_threads, pix_fmt, dtype, layout, mean, std) -> "
+                   "tuple(decoded video ndarray, seek_distance) or\n"
+                   "tuple(decoded video ndarray, width, height, seek_distance)\n"
+                   "if width and height are not passed as arguments.\n"
+                   "The decoded video is an ndarray of shape (num_frames, height, width, 3), or of\n"
+                   "shape (num_frames, 3, height, width) with planar R, G and B if layout is 'NCHW'.\n"
+                   "hwaccel names an FFmpeg hardware device type to decode with, e.g., 'cuda',\n"
+                   "'vaapi' or 'videotoolbox'; decoding falls back to software if it is unavailable.\n"
+                   "If out is passed, e.g., from lintel.make_output_buffer, frames are decoded\n"
+                   "into it in place, and it is returned instead of a new ndarray.\n"
+                   "num_threads is the number of decoding threads, by default 0, i.e., one per CPU core.\n"
+                   "dtype is one of 'uint8' (the default), 'float32', 'float16' or 'bfloat16'.\n"
+                   "Floating point frames are scaled to [0, 1] and normalized per (R, G, B) channel\n"
+                   "by mean and std, which default to 0 and 1. bfloat16 frames are returned as\n"
+                   "their uint16 bit patterns.\n"
+                   "pix_fmt is one of 'rgb24' (the default), 'yuv420p' or 'gray'. 'yuv420p' frames\n"
+                   "are uint8 ndarrays of shape (num_frames, height*3/2, width), holding the Y plane\n"
+                   "followed by the U and V planes, and 'gray' frames hold only the Y plane, with a\n"
+                   "single channel. These are copied straight out of the decoder, skipping colour\n"
+                   "conversion, when the decoder outputs YUV420P (or, for 'gray', any 8-bit YUV).")},
         {"loadvid_frame_nums",
          (PyCFunction)loadvid_frame_nums,
          METH_VARARGS | METH_KEYWORDS,
-         PyDoc_STR("loadvid_frame_nums(encoded_video, frame_nums, width, height, should_seek) -> "
-                   "decoded video ByteArray object or\n"
-                   "tuple(decoded video ByteArray object, width, height)\n"
-                   "if width and height are not passed as arguments.")},
+         PyDoc_STR("loadvid_frame_nums(encoded_video, frame_nums, width, height, should_seek, hwaccel, out, num_threads, pix_fmt, dtype, layout, mean, std) -> "
+                   "decoded video ndarray or\n"
+                   "tuple(decoded video ndarray, width, height)\n"
+                   "if width and height are not passed as arguments.\n"
+                   "The decoded video is an ndarray of shape (len(frame_nums), height, width, 3),\n"
+                   "with elements of type dtype and laid out as given by layout (see loadvid).\n"
+                   "frame_nums must be strictly increasing (lintel.loadvid_frame_nums sorts them).")},
+        {"loadvid_frame_nums_into",
+         (PyCFunction)loadvid_frame_nums_into,
+         METH_VARARGS | METH_KEYWORDS,
+         PyDoc_STR("loadvid_frame_nums_into(encoded_video, out, frame_nums, offset, width, height, hwaccel, num_threads, pix_fmt, dtype, layout, mean, std) -> None\n"
+                   "Seeks to the keyframe before frame_nums[0], and decodes frame_nums into\n"
+                   "the writable buffer out, starting at frame index offset. Releases the GIL.")},
+        {"get_keyframe_frame_nums",
+         (PyCFunction)get_keyframe_frame_nums,
+         METH_VARARGS | METH_KEYWORDS,
+         PyDoc_STR("get_keyframe_frame_nums(encoded_video) -> "
+                   "tuple(list of keyframe frame numbers, width, height, nb_frames)\n"
+                   "nb_frames is the (possibly approximate) number of frames in the video.")},
         {NULL, NULL, 0, NULL}
 };
 
+static int
+lintel_exec(PyObject *module)
+{
+        if (PyType_Ready(&video_reader_type) < 0)
+                return -1;
+
+        Py_INCREF(&video_reader_type);
+        if (PyModule_AddObject(module,
+                               "VideoReader",
+                               (PyObject *)&video_reader_type) < 0) {
+                Py_DECREF(&video_reader_type);
+                return -1;
+        }
+
+        return 0;
+}
+
+static PyModuleDef_Slot lintel_slots[] = {
+        {Py_mod_exec, lintel_exec},
+        {0, NULL}
+};
+
 static struct PyModuleDef
 lintelmodule = {
         PyModuleDef_HEAD_INIT,
@@ -483,7 +1557,7 @@ lintelmodule = {
         module_doc,
         0,
         lintel_methods,
-        NULL,
+        lintel_slots,
         NULL,
         NULL,
         NULL
@@ -492,6 +1566,8 @@ lintelmodule = {
 PyMODINIT_FUNC
 PyInit__lintel(void)
 {
+        import_array();
+
         av_register_all();
         av_log_set_level(AV_LOG_ERROR);
         srand(time(NULL));
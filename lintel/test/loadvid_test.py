@@ -13,102 +13,390 @@
 # limitations under the License.
 
 """Unit test for loadvid."""
-import random
+import mmap
+import os
+import sys
+import tempfile
 import time
 
 import click
 import numpy as np
-import matplotlib.pyplot as plt
 
 import lintel
 
 
-def _loadvid_test_vanilla(filename, width, height):
-    """Tests the usual loadvid call.
+def _to_displayable(frames, out_format):
+    """Converts `frames`, decoded in the format given by the `out_format`
+    keyword arguments, to a (num_frames, height, width, channels) array that
+    `matplotlib.pyplot.imshow` can plot.
 
-    The input file, an encoded video corresponding to `filename`, is repeatedly
-    decoded (with a random seek). The first and last of the returned frames are
-    plotted using `matplotlib.pyplot`.
+    'yuv420p' frames are shown as single channel images of their stacked Y, U
+    and V planes, and floating point frames are assumed to be in [0, 1], i.e.,
+    decoded without `mean` and `std`.
+    """
+    if out_format['pix_fmt'] == 'yuv420p':
+        return frames[..., np.newaxis]
+
+    if out_format['layout'] == 'NCHW':
+        frames = np.transpose(frames, (0, 2, 3, 1))
+
+    if out_format['dtype'] == 'bfloat16':
+        frames = (frames.astype(np.uint32) << 16).view(np.float32)
+    elif out_format['dtype'] == 'float16':
+        frames = frames.astype(np.float32)
+
+    if out_format['dtype'] != 'uint8':
+        frames = np.clip(frames, 0.0, 1.0)
+
+    return frames
+
+
+def _show_frames(frames, frames_per_row=8):
+    """Plots `frames`, a (num_frames, height, width, channels) array, as one
+    grid image with a single (blocking) `matplotlib.pyplot.show` call.
+
+    Single channel frames are plotted in grayscale.
+
+    On a headless Linux machine (no X11 or Wayland display), where the plot
+    cannot be shown, matplotlib is switched to the non-interactive Agg backend
+    and the plot is saved to a temporary PNG file instead.
+
+    NOTE(brendan): matplotlib is imported here, rather than at module level,
+    so that benchmarking runs without --visualize do not pay for importing it
+    (nor require it to be installed).
+    """
+    import matplotlib
+
+    is_headless = (sys.platform.startswith('linux') and
+                   ('DISPLAY' not in os.environ) and
+                   ('WAYLAND_DISPLAY' not in os.environ))
+    if is_headless:
+        matplotlib.use('Agg')
+
+    import matplotlib.pyplot as plt
+
+    num_frames, height, width, channels = frames.shape
+    frames_per_row = min(frames_per_row, num_frames)
+    num_rows = -(-num_frames // frames_per_row)
+
+    grid = np.zeros((num_rows*frames_per_row, height, width, channels),
+                    dtype=frames.dtype)
+    grid[:num_frames] = frames
+    grid = np.reshape(grid,
+                      (num_rows, frames_per_row, height, width, channels))
+    grid = np.transpose(grid, (0, 2, 1, 3, 4))
+    grid = np.reshape(grid,
+                      (num_rows*height, frames_per_row*width, channels))
+
+    if channels == 1:
+        plt.imshow(grid[..., 0], cmap='gray')
+    else:
+        plt.imshow(grid)
+
+    if is_headless:
+        fd, filename = tempfile.mkstemp(prefix='lintel_frames_', suffix='.png')
+        os.close(fd)
+        plt.savefig(filename)
+        plt.close()
+        print('frames: {}'.format(filename))
+    else:
+        plt.show()
+
+
+def _open_video(filename):
+    """Opens the video corresponding to `filename`.
+
+    The video file is memory-mapped rather than read into a bytes object, so
+    Lintel decodes straight from the page cache without copying the file.
     """
     with open(filename, 'rb') as f:
-        encoded_video = f.read()
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def _open_video_reader(encoded_video,
+                       width,
+                       height,
+                       hwaccel,
+                       num_threads,
+                       out_format):
+    """Opens `encoded_video` with a `lintel.VideoReader`, which keeps the video
+    open across the test iterations, and decodes frames in the format given by
+    the `out_format` keyword arguments.
+
+    If `width` and `height` are passed, they are checked against the size of
+    the video.
+
+    Returns a tuple (reader, width, height), with the size of the video.
+    """
+    reader = lintel.VideoReader(encoded_video,
+                                hwaccel=hwaccel,
+                                num_threads=num_threads,
+                                **out_format)
+    if (width != 0) or (height != 0):
+        assert (reader.width, reader.height) == (width, height)
+
+    return reader, reader.width, reader.height
+
+
+def _make_output_buffer(num_frames, width, height, out_format):
+    """Allocates an output buffer for `num_frames` frames of size
+    `width`x`height`, in the format given by the `out_format` keyword
+    arguments.
+
+    Returns None if the size of the video is not known, i.e., is being found
+    dynamically, in which case Lintel allocates the output.
+    """
+    if (width == 0) and (height == 0):
+        return None
+
+    return lintel.make_output_buffer(num_frames, height, width, **out_format)
+
+
+def _check_dynamic_size(frames, width, height, out_format):
+    """Checks that `frames`, decoded with a dynamically found video size, have
+    the shape of frames of the returned size `width`x`height`.
+    """
+    frame_shape = lintel.make_output_buffer(1,
+                                            height,
+                                            width,
+                                            **out_format).shape[1:]
+    assert frames.shape[1:] == frame_shape, (frames.shape, width, height)
+
+
+def _load_frame_nums(encoded_video,
+                     reader,
+                     frame_nums,
+                     width,
+                     height,
+                     should_seek,
+                     num_shards,
+                     hwaccel,
+                     num_threads,
+                     out_format,
+                     out):
+    """Decodes `frame_nums` with `reader.load`, or with `loadvid_frame_nums` if
+    `reader` is None, or to decode shards in parallel if `num_shards` is
+    greater than one.
+
+    If `width` and `height` are zero, `loadvid_frame_nums` finds the size of
+    the video, which is checked against the decoded frames.
+    """
+    if (reader is not None) and (num_shards <= 1):
+        return reader.load(frame_nums, should_seek=should_seek, out=out)
+
+    result = lintel.loadvid_frame_nums(encoded_video,
+                                       frame_nums=frame_nums,
+                                       width=width,
+                                       height=height,
+                                       should_seek=should_seek,
+                                       num_shards=num_shards,
+                                       hwaccel=hwaccel,
+                                       out=out,
+                                       num_threads=num_threads,
+                                       **out_format)
+    if (width != 0) or (height != 0):
+        return result
+
+    decoded_frames, video_width, video_height = result
+    _check_dynamic_size(decoded_frames, video_width, video_height, out_format)
+
+    return decoded_frames
+
+
+def _loadvid_test_vanilla(filename,
+                          width,
+                          height,
+                          use_reader,
+                          hwaccel,
+                          num_threads,
+                          out_format,
+                          visualize):
+    """Tests the usual loadvid call, through `lintel.VideoReader.load_clip`, or
+    through `lintel.loadvid` if `use_reader` is not set.
+
+    The input file, an encoded video corresponding to `filename`, is opened
+    once and repeatedly decoded (with a random seek). If `visualize` is set,
+    the first and last of the returned frames are plotted using
+    `matplotlib.pyplot`.
+
+    If `width` and `height` are zero, `lintel.loadvid` finds the size of the
+    video, which is checked against the decoded frames.
+    """
+    encoded_video = _open_video(filename)
+    if use_reader:
+        reader, width, height = _open_video_reader(encoded_video,
+                                                   width,
+                                                   height,
+                                                   hwaccel,
+                                                   num_threads,
+                                                   out_format)
 
     num_frames = 32
+    out = _make_output_buffer(num_frames, width, height, out_format)
+
     for _ in range(10):
         start = time.perf_counter()
-        result = lintel.loadvid(encoded_video,
-                                should_random_seek=True,
-                                width=width,
-                                height=height,
-                                num_frames=num_frames)
-
-        # NOTE(brendan): dynamic size returns (frames, width, height,
-        # seek_distance).
-        if (width == 0) and (height == 0):
-            decoded_frames, width, height, _ = result
+        if use_reader:
+            decoded_frames, _ = reader.load_clip(num_frames=num_frames,
+                                                 should_random_seek=True,
+                                                 out=out)
         else:
-            decoded_frames, _ = result
-
-        decoded_frames = np.frombuffer(decoded_frames, dtype=np.uint8)
-        decoded_frames = np.reshape(decoded_frames,
-                                    newshape=(num_frames, height, width, 3))
+            result = lintel.loadvid(encoded_video,
+                                    should_random_seek=True,
+                                    width=width,
+                                    height=height,
+                                    num_frames=num_frames,
+                                    hwaccel=hwaccel,
+                                    out=out,
+                                    num_threads=num_threads,
+                                    **out_format)
+            if (width != 0) or (height != 0):
+                decoded_frames, _ = result
+            else:
+                decoded_frames, video_width, video_height, _ = result
+                _check_dynamic_size(decoded_frames,
+                                    video_width,
+                                    video_height,
+                                    out_format)
         end = time.perf_counter()
 
         print('time: {}'.format(end - start))
-        plt.imshow(decoded_frames[0, ...])
-        plt.show()
-        plt.imshow(decoded_frames[-1, ...])
-        plt.show()
+        if visualize:
+            _show_frames(_to_displayable(decoded_frames[[0, -1], ...],
+                                         out_format))
 
 
 def _loadvid_test_frame_nums(filename,
                              width,
                              height,
+                             use_reader,
                              start_frame,
-                             should_seek):
+                             should_seek,
+                             num_shards,
+                             hwaccel,
+                             num_threads,
+                             out_format,
+                             visualize):
     """Tests loadvid_frame_nums Python extension.
 
-    `loadvid_frame_nums` takes a list of (strictly increasing, and not
-    repeated) frame indices to decode from the encoded video corresponding to
-    `filename`.
+    `loadvid_frame_nums` takes a list of frame indices to decode from the
+    encoded video corresponding to `filename`. The indices sampled here are
+    strictly increasing, so that they are decoded without being re-ordered.
 
     This function randomly selects frames to decode, in a loop, decodes the
-    chosen frames with `loadvid_frame_nums`, and visualizes the resulting
-    frames (all of them) using `matplotlib.pyplot`.
+    chosen frames with `lintel.VideoReader.load` (or with
+    `loadvid_frame_nums`, if `use_reader` is not set or to decode shards in
+    parallel if `num_shards` is greater than one), and, if `visualize` is set,
+    visualizes the resulting frames (all of them) using `matplotlib.pyplot`.
     """
-    with open(filename, 'rb') as f:
-        encoded_video = f.read()
+    encoded_video = _open_video(filename)
+    reader = None
+    if use_reader:
+        reader, width, height = _open_video_reader(encoded_video,
+                                                   width,
+                                                   height,
+                                                   hwaccel,
+                                                   num_threads,
+                                                   out_format)
 
     num_frames = 32
+    out = _make_output_buffer(num_frames, width, height, out_format)
+
     for _ in range(10):
+        frame_steps = np.random.randint(1, 4, size=num_frames - 1)
+        frame_nums = np.cumsum(frame_steps) + start_frame
+        frame_nums = [start_frame] + frame_nums.tolist()
+
         start = time.perf_counter()
+        decoded_frames = _load_frame_nums(encoded_video,
+                                          reader,
+                                          frame_nums,
+                                          width,
+                                          height,
+                                          should_seek,
+                                          num_shards,
+                                          hwaccel,
+                                          num_threads,
+                                          out_format,
+                                          out)
+        end = time.perf_counter()
 
-        i = start_frame
-        frame_nums = []
-        for _ in range(num_frames):
-            frame_nums.append(i)
-            i += int(random.uniform(1, 4))
+        print('time: {}'.format(end - start))
+        if visualize:
+            _show_frames(_to_displayable(decoded_frames, out_format))
 
-        result = lintel.loadvid_frame_nums(encoded_video,
-                                           frame_nums=frame_nums,
-                                           width=width,
-                                           height=height,
-                                           should_seek=should_seek)
 
-        if (width == 0) and (height == 0):
-            decoded_frames, width, height = result
-        else:
-            decoded_frames = result
+def _loadvid_test_frame_order(filename,
+                              width,
+                              height,
+                              use_reader,
+                              start_frame,
+                              should_seek,
+                              num_shards,
+                              hwaccel,
+                              num_threads,
+                              out_format):
+    """Tests decoding frame indices that are out of order and repeated.
 
-        decoded_frames = np.frombuffer(decoded_frames, dtype=np.uint8)
-        decoded_frames = np.reshape(decoded_frames,
-                                    newshape=(num_frames, height, width, 3))
-        end = time.perf_counter()
+    Lintel decodes the unique frame indices in increasing order, and then
+    gathers the decoded frames in the requested order. This checks, for
+    randomly sampled frame indices, that the frames decoded from the indices
+    as sampled are the frames decoded from the sorted, unique indices, gathered
+    in the sampled order, both with and without an `out` buffer (if the size of
+    the video is known).
+    """
+    encoded_video = _open_video(filename)
+    reader = None
+    if use_reader:
+        reader, width, height = _open_video_reader(encoded_video,
+                                                   width,
+                                                   height,
+                                                   hwaccel,
+                                                   num_threads,
+                                                   out_format)
 
-        print('time: {}'.format(end - start))
-        for i in range(num_frames):
-            plt.imshow(decoded_frames[i, ...])
-            plt.show()
+    num_frames = 32
+    out = _make_output_buffer(num_frames, width, height, out_format)
+
+    for _ in range(10):
+        frame_nums = np.random.randint(start_frame,
+                                       start_frame + 2*num_frames,
+                                       size=num_frames - 1)
+        frame_nums = np.append(frame_nums, frame_nums[0])
+        unique_frame_nums, inverse = np.unique(frame_nums,
+                                               return_inverse=True)
+
+        expected = _load_frame_nums(encoded_video,
+                                    reader,
+                                    unique_frame_nums.tolist(),
+                                    width,
+                                    height,
+                                    should_seek,
+                                    num_shards,
+                                    hwaccel,
+                                    num_threads,
+                                    out_format,
+                                    None)
+        expected = expected[inverse]
+
+        test_outs = [None] if out is None else [None, out]
+        for test_out in test_outs:
+            decoded_frames = _load_frame_nums(encoded_video,
+                                              reader,
+                                              frame_nums.tolist(),
+                                              width,
+                                              height,
+                                              should_seek,
+                                              num_shards,
+                                              hwaccel,
+                                              num_threads,
+                                              out_format,
+                                              test_out)
+            if test_out is not None:
+                assert decoded_frames is test_out
+            assert np.array_equal(decoded_frames, expected)
+
+    print('frame order: OK')
 
 
 @click.command()
@@ -134,6 +422,17 @@ def _loadvid_test_frame_nums(filename,
 @click.option('--loadvid',
               'test_name',
               flag_value='loadvid')
+@click.option('--frame-order',
+              'test_name',
+              flag_value='frame_order',
+              help='Check decoding of out of order and repeated frame '
+                   'numbers.')
+@click.option('--reader/--no-reader',
+              'use_reader',
+              default=True,
+              help='Whether to decode through lintel.VideoReader, or through '
+                   'the module-level lintel.loadvid and '
+                   'lintel.loadvid_frame_nums functions.')
 @click.option('--should-seek/--no-should-seek',
               default=False,
               help='Whether to use the potentially frame-inaccurate seek.')
@@ -141,17 +440,54 @@ def _loadvid_test_frame_nums(filename,
               default=0,
               type=int,
               help='Which frame to start decoding from.')
+@click.option('--num-shards',
+              default=1,
+              type=int,
+              help='Number of keyframe-aligned shards to decode in parallel '
+                   '(requires --should-seek).')
+@click.option('--hwaccel',
+              default=None,
+              type=str,
+              help='FFmpeg hardware device type to decode with, e.g., cuda.')
+@click.option('--num-threads',
+              default=0,
+              type=int,
+              help='Number of FFmpeg decoding threads (0 for one per core).')
+@click.option('--pix-fmt',
+              default='rgb24',
+              type=click.Choice(['rgb24', 'yuv420p', 'gray']),
+              help='Pixel format of the decoded frames.')
+@click.option('--dtype',
+              default='uint8',
+              type=click.Choice(['uint8', 'float32', 'float16', 'bfloat16']),
+              help='Element type of the decoded frames.')
+@click.option('--layout',
+              default='NHWC',
+              type=click.Choice(['NHWC', 'NCHW']),
+              help='Memory layout of each decoded frame.')
+@click.option('--visualize/--no-visualize',
+              default=False,
+              help='Whether to plot the decoded frames with matplotlib.')
 def loadvid_test(dynamic_size,
                  filename,
                  width,
                  height,
                  test_name,
+                 use_reader,
                  should_seek,
-                 start_frame):
+                 start_frame,
+                 num_shards,
+                 hwaccel,
+                 num_threads,
+                 pix_fmt,
+                 dtype,
+                 layout,
+                 visualize):
     """Tests the lintel.loadvid Python extension.
 
     This program will run tests to sanity check -- visually, by using
-    matplotlib to plot individual frames -- that Lintel is working.
+    matplotlib to plot decoded frames if --visualize is passed -- that Lintel
+    is working.
 
     This program also acts as a sample use case for the APIs provided by
     Lintel.
@@ -160,11 +496,37 @@ def loadvid_test(dynamic_size,
         width = 0
         height = 0
 
+    out_format = {'pix_fmt': pix_fmt, 'dtype': dtype, 'layout': layout}
+
     if test_name == 'loadvid':
-        _loadvid_test_vanilla(filename, width, height)
+        _loadvid_test_vanilla(filename,
+                              width,
+                              height,
+                              use_reader,
+                              hwaccel,
+                              num_threads,
+                              out_format,
+                              visualize)
     elif test_name == 'frame_nums':
         _loadvid_test_frame_nums(filename,
                                  width,
                                  height,
+                                 use_reader,
                                  start_frame,
-                                 should_seek)
+                                 should_seek,
+                                 num_shards,
+                                 hwaccel,
+                                 num_threads,
+                                 out_format,
+                                 visualize)
+    elif test_name == 'frame_order':
+        _loadvid_test_frame_order(filename,
+                                  width,
+                                  height,
+                                  use_reader,
+                                  start_frame,
+                                  should_seek,
+                                  num_shards,
+                                  hwaccel,
+                                  num_threads,
+                                  out_format)
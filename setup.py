@@ -14,6 +14,8 @@
 
 """Installs Lintel, the video decoding Python module."""
 import distutils.core
+
+import numpy
 import setuptools
 
 
@@ -21,7 +23,7 @@ lintel_module = distutils.core.Extension(
     '_lintel',
     define_macros=[('MAJOR_VERSION', '1'), ('MINOR_VERSION', '0')],
     undef_macros=['NDEBUG'],
-    include_dirs=['/usr/include/ffmpeg', 'lintel'],
+    include_dirs=['/usr/include/ffmpeg', 'lintel', numpy.get_include()],
     libraries=['avformat', 'avcodec', 'swscale', 'avutil', 'swresample'],
     sources=['lintel/py_ext/lintelmodule.c',
              'lintel/core/video_decode.c'])
@@ -40,6 +42,7 @@ setuptools.setup(author='Brendan Duke',
                      lintel_test=lintel.test.loadvid_test:loadvid_test
                  """,
                  install_requires=['Click', 'numpy'],
+                 extras_require={'test': ['matplotlib']},
                  ext_modules=[lintel_module],
                  packages=setuptools.find_packages(),
                  py_modules=['lintel.test.loadvid_test'],